@@ -57,6 +57,8 @@ apt_package_check_list=(
   python-gdata
   imagemagick
   cups
+  mpg321
+  alsa-utils
   python-cups
 )
 
@@ -0,0 +1,176 @@
+'''
+    Searchable index of the user's Google Photos albums
+
+    The setup assistant used to download the whole album list each time the
+    album selection opened, and to scan every title on each keystroke. The
+    index below is kept between openings (refreshed once it is older than its
+    time to live), is filled page by page while the list is downloading, and
+    answers substring searches from a trigram index. AlbumSearch narrows the
+    previous matches when the pattern only grows, so typing stays cheap on
+    accounts with thousands of albums.
+'''
+import time
+import logging
+log = logging.getLogger(__name__)
+
+
+class AlbumIndex:
+    """Album titles and ids with a trigram index for case insensitive substring search"""
+    def __init__(self, ttl = 600):
+        """Create an empty index
+
+        Arguments:
+            ttl (int) : how long (s) a complete album list is considered up to date
+        """
+        self.ttl = ttl
+        self.loaded_at = None   # end of the last complete refresh
+        self.generation = 0     # incremented when positions change (see AlbumSearch)
+        self._albums = []       # {"title", "id"} in server order
+        self._titles = []       # lowercased titles, same positions
+        self._positions = {}    # id -> position
+        self._trigrams = {}     # 3 characters -> positions of the titles containing them
+        self._seen = None       # ids received by the running refresh
+        self._dirty = False     # a title changed during the running refresh
+
+    def __len__(self):
+        return len(self._albums)
+
+    def album(self, position):
+        """{"title", "id"} of the album at position"""
+        return self._albums[position]
+
+    def stale(self):
+        """True if the index was never completely loaded or is older than its time to live"""
+        return self.loaded_at is None or time.time() - self.loaded_at > self.ttl
+
+    def begin_refresh(self):
+        """Start an incremental refresh: albums are then given with add() and end_refresh() prunes the others"""
+        self._seen = set()
+        self._dirty = False
+
+    def add(self, albums):
+        """Add albums ({"title", "id"}) to the index, updating the titles of the known ones
+
+        returns: the number of new albums (they are appended, see AlbumSearch)
+        """
+        added = 0
+        for album in albums:
+            title, album_id = album.get("title"), album.get("id")
+            if title is None or album_id is None:
+                continue
+            if self._seen is not None:
+                self._seen.add(album_id)
+            position = self._positions.get(album_id)
+            if position is not None:
+                if self._albums[position]["title"] != title:
+                    self._albums[position] = {"title": title, "id": album_id}
+                    self._dirty = True
+                continue
+            self.__append(title, album_id)
+            added += 1
+        return added
+
+    def end_refresh(self):
+        """Complete the refresh: remove the albums that were not received and reset the time to live"""
+        if self._seen is not None:
+            kept = [album for album in self._albums if album["id"] in self._seen]
+            if self._dirty or len(kept) != len(self._albums):
+                log.debug("AlbumIndex: %d albums removed, rebuilding the index"%(len(self._albums) - len(kept)))
+                self.__rebuild(kept)
+        self._seen = None
+        self.loaded_at = time.time()
+
+    def search(self, pattern, candidates = None):
+        """Positions of the albums whose title contains pattern (case insensitive), in server order
+
+        Arguments:
+            pattern (str)     : the text to search
+            candidates (list) : only look at these positions (defaults to the whole index)
+        """
+        pattern = pattern.lower()
+        if candidates is None:
+            if len(pattern) >= 3:
+                # all titles containing pattern contain each of its trigrams: start from the rarest
+                postings = [self._trigrams.get(pattern[i:i + 3], []) for i in range(len(pattern) - 2)]
+                candidates = min(postings, key = len)
+                if len(pattern) == 3:
+                    return list(candidates)
+            else:
+                candidates = xrange(len(self._titles))
+        titles = self._titles
+        return [position for position in candidates if pattern in titles[position]]
+
+    def __append(self, title, album_id):
+        position = len(self._albums)
+        self._albums.append({"title": title, "id": album_id})
+        self._positions[album_id] = position
+        title = title.lower()
+        self._titles.append(title)
+        for trigram in set([title[i:i + 3] for i in range(len(title) - 2)]):
+            self._trigrams.setdefault(trigram, []).append(position)
+
+    def __rebuild(self, albums):
+        self._albums, self._titles, self._positions, self._trigrams = [], [], {}, {}
+        for album in albums:
+            self.__append(album["title"], album["id"])
+        self.generation += 1
+
+
+class AlbumSearch:
+    """Incremental search in an AlbumIndex, for a pattern edited one keystroke at a time"""
+    def __init__(self, index):
+        self.index = index
+        self.pattern = None
+        self.matches = []       # positions matching self.pattern
+        self._size = 0          # size of the index when matches were computed
+        self._generation = None
+
+    def update(self, pattern):
+        """Positions of the albums matching pattern
+
+        When pattern extends the previous one, only the previous matches and
+        the albums added since are checked.
+        """
+        pattern = pattern.lower()
+        index = self.index
+        narrowing = self.pattern is not None and self._generation == index.generation and self.pattern in pattern
+        # a pattern reaching 3 characters is better served by the trigrams than by the previous matches
+        if narrowing and (len(self.pattern) >= 3 or len(pattern) < 3):
+            matches = index.search(pattern, self.matches)
+            matches.extend(index.search(pattern, xrange(self._size, len(index))))
+        else:
+            matches = index.search(pattern)
+        self.pattern = pattern
+        self.matches = matches
+        self._size = len(index)
+        self._generation = index.generation
+        return matches
+
+
+if __name__ == '__main__':
+    # Benchmark: linear scan of the titles at each keystroke vs indexed incremental search
+    import random
+    words = ["wedding", "party", "birthday", "holidays", "summer", "winter", "family", "friends", "booth", "selfie"]
+    albums = [{"title": "%s %s %d" % (random.choice(words).capitalize(), random.choice(words), i), "id": "id%d" % i} for i in range(5000)]
+    keystrokes = ["w", "we", "wed", "wedd", "weddi", "weddin", "wedding", "wedding ", "wedding p", "wedding pa"]
+
+    start = time.time()
+    for pattern in keystrokes:
+        linear = [album for album in albums if album["title"].lower().find(pattern.lower()) != -1]
+    linear_time = (time.time() - start) / len(keystrokes)
+
+    index = AlbumIndex()
+    start = time.time()
+    for page in range(0, len(albums), 50):
+        index.add(albums[page:page + 50])
+    build_time = time.time() - start
+    search = AlbumSearch(index)
+    start = time.time()
+    for pattern in keystrokes:
+        matches = search.update(pattern)
+    indexed_time = (time.time() - start) / len(keystrokes)
+    assert [index.album(position) for position in matches] == linear
+
+    print "%d albums, index built in %.1fms" % (len(albums), build_time * 1000)
+    print "linear scan per keystroke:       %.2fms" % (linear_time * 1000)
+    print "incremental search per keystroke: %.2fms" % (indexed_time * 1000)
@@ -0,0 +1,134 @@
+'''
+    Caches of image assets prepared once for the screen or the snap size
+
+    Assets never change while the booth is running, so resizing and padding
+    them for each use is wasted work: the caches below keep the ready-to-use
+    version and only rebuild it when the target size or the asset file changes.
+'''
+import os
+from PIL import Image
+import logging
+log = logging.getLogger(__name__)
+
+
+def _asset_stamp(path):
+    """Modification time of an asset (None if it doesn't exist)"""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class CountdownOverlayCache:
+    """Padded RGBA buffers of the countdown images, ready for camera.add_overlay"""
+    def __init__(self, image_files, height_ratio):
+        """Create the cache (call build() to precompute the overlays)
+
+        Arguments:
+            image_files (list) : countdown image files, image_files[0] is shown during the last second
+            height_ratio       : height of the countdown images wrt. the preview height [0. - 1.]
+        """
+        self.image_files = image_files
+        self.height_ratio = height_ratio
+        self._key = None
+        self._overlays = []
+
+    def __key(self, screen_size):
+        return (tuple(screen_size), tuple([(path, _asset_stamp(path)) for path in self.image_files]))
+
+    def build(self, screen_size):
+        """Precompute the overlays for this screen size (no-op if they are up to date)
+
+        Arguments:
+            screen_size tupple(w,h) : size of the preview (the screen in fullscreen mode)
+        """
+        key = self.__key(screen_size)
+        if key == self._key:
+            return
+        log.debug("CountdownOverlayCache: building overlays for screen size %s"%repr(screen_size))
+        self._overlays = [self.__build_overlay(path, screen_size) for path in self.image_files]
+        self._key = key
+
+    def get(self, index, screen_size):
+        """Returns the overlay for image_files[index] as (bytes, (width, height)), or None
+
+        The cache is rebuilt if the screen size or the image files changed
+        """
+        self.build(screen_size)
+        return self._overlays[index]
+
+    def __build_overlay(self, path, screen_size):
+        preview_width, preview_height = screen_size
+        overlay_height = int(preview_height * self.height_ratio)
+        try:
+            # read overlay image file
+            file = Image.open(path)
+            # resize to height_ratio of height
+            file.thumbnail((preview_width, overlay_height))
+        except IOError as e:
+            log.warning("CountdownOverlayCache: unable to read %s (%s)"%(path, str(e)))
+            return None
+
+        # overlays should be padded to 32 (width) and 16 (height)
+        pad_width  = int((preview_width + 31) / 32) * 32
+        pad_height = int((preview_height + 15) / 16) * 16
+
+        image = Image.new('RGBA', (pad_width, pad_height))
+        # Paste the original image into the padded one (centered)
+        image.paste(file, ( int((preview_width - file.size[0]) / 2.0), int((preview_height - file.size[1]) / 2.0)))
+        return (image.tobytes(), image.size)
+
+
+class ForegroundCache:
+    """Foreground frames resized once to the picture size, split into color and alpha planes"""
+    def __init__(self):
+        self._entries = {} # (path, size, mode) -> (mtime, (image, mask))
+
+    def get(self, path, size, mode = 'RGB'):
+        """Returns (image, mask) for the foreground asset at path, resized to size
+
+        image is in the given mode, mask is its alpha channel ('L'):
+        canvas.paste(image, (0, 0), mask) composites the foreground in a single pass.
+        The entry is rebuilt if the asset file changed.
+
+        Arguments:
+            path (str)            : foreground image file (with transparency)
+            size tupple(w,h)      : size of the picture
+            mode (str)            : mode of the picture the foreground is pasted on
+        """
+        key = (path, tuple(size), mode)
+        stamp = _asset_stamp(path)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stamp:
+            log.debug("ForegroundCache: preparing %s for size %s"%(path, repr(size)))
+            front = Image.open(path).convert('RGBA').resize(tuple(size))
+            entry = (stamp, (front.convert(mode), front.split()[3]))
+            self._entries[key] = entry
+        return entry[1]
+
+
+if __name__ == '__main__':
+    # Benchmark: collage foreground resized for each collage vs cached
+    import time
+    from constants import MODE_PARAMETERS
+    w, h = MODE_PARAMETERS['collage']['snap_size']
+    path = MODE_PARAMETERS['collage']['foreground_image']
+    runs = 5
+
+    start = time.time()
+    for run in range(runs):
+        snapshot = Image.new('RGBA', (w * 2, h * 2), (128, 128, 128, 255))
+        front = Image.open(path).resize((w * 2, h * 2)).convert('RGBA')
+        snapshot = Image.alpha_composite(snapshot.convert('RGBA'), front).convert('RGB')
+    uncached = (time.time() - start) / runs
+
+    cache = ForegroundCache()
+    cache.get(path, (w * 2, h * 2))
+    start = time.time()
+    for run in range(runs):
+        snapshot = Image.new('RGB', (w * 2, h * 2), (128, 128, 128))
+        front, mask = cache.get(path, (w * 2, h * 2))
+        snapshot.paste(front, (0, 0), mask)
+    cached = (time.time() - start) / runs
+    print "foreground resized for each collage: %.1fms" % (uncached * 1000)
+    print "cached foreground:                   %.1fms" % (cached * 1000)
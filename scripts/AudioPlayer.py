@@ -0,0 +1,210 @@
+'''
+    Low-latency playback of the booth sound clips
+
+    Clips are decoded once (mpg321 -w) and converted to a single PCM format,
+    then played by a writer thread that feeds one long-lived 'aplay' process.
+    The writer sends small chunks paced to the playback rate, so only a few
+    tens of milliseconds are ever queued ahead of the speaker, and a new clip
+    cuts the one still playing instead of waiting behind it. play() only
+    queues the request and returns, so sounds never block the capture path.
+    If decoding or aplay is not available, clips fall back to a detached
+    mpg321 process each.
+'''
+import os
+import time
+import wave
+import audioop
+import shutil
+import tempfile
+import threading
+import subprocess
+import Queue
+import logging
+log = logging.getLogger(__name__)
+
+
+class AudioPlayer:
+    """Plays preloaded clips asynchronously through a persistent output process"""
+    OUTPUT_FORMAT = (44100, 2, 2) # (rate, channels, bytes per sample) every clip is converted to
+    BUFFER_TIME = 50000 # output buffer of the player (us), keeps playback latency low
+    CHUNK_TIME = 0.01   # clips are written by chunks of this duration (s)
+    MAX_LATENCY = 0.1   # self-test limit of the delay between play() and the clip reaching the speaker (s)
+    def __init__(self, clips, decoder = "mpg321", player = "aplay"):
+        """Decode the clips and start the writer thread
+
+        Arguments:
+            clips (dict) : clip name -> mp3 file path
+            decoder      : mp3 decoder command (must support '-q -w <wav file>')
+            player       : raw PCM player command (must support aplay options)
+        """
+        self.clips = clips
+        self.decoder = decoder
+        self.player = player
+        self.buffers = {}       # name -> pcm bytes in OUTPUT_FORMAT
+        self.played_at = {}     # name -> time of the last play() request of the clip
+        self.heard_at = {}      # name -> time at which its first sample reaches the speaker:
+                                # the output plays what was written before it at the playback rate
+        self.latency = {}       # name -> heard_at - played_at
+        self._output = None     # aplay process
+        self._queue = Queue.Queue()
+        self._devnull = open(os.devnull, 'w')
+        rate, channels, width = self.OUTPUT_FORMAT
+        self._frame_size = channels * width
+        self._chunk_size = int(rate * self.CHUNK_TIME) * self._frame_size
+        self.__decode_all()
+        self._thread = threading.Thread(target = self.__run, name = "audio")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __decode_all(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for name, path in self.clips.items():
+                wav_file = os.path.join(tmp_dir, name + ".wav")
+                try:
+                    subprocess.check_call([self.decoder, "-q", "-w", wav_file, path], stdout = self._devnull, stderr = self._devnull)
+                    clip = wave.open(wav_file, 'rb')
+                    pcm_format = (clip.getframerate(), clip.getnchannels(), clip.getsampwidth())
+                    self.buffers[name] = self.__convert(clip.readframes(clip.getnframes()), *pcm_format)
+                    clip.close()
+                    log.debug("AudioPlayer: decoded %s (%dHz, %d channel(s), %.2fs)"%(path, pcm_format[0], pcm_format[1],
+                        len(self.buffers[name]) / float(self._frame_size * self.OUTPUT_FORMAT[0])))
+                except Exception as e:
+                    log.warning("AudioPlayer: unable to decode %s, will use %s for it (%s)"%(path, self.decoder, repr(e)))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    def __convert(self, pcm, rate, channels, width):
+        """PCM data converted to OUTPUT_FORMAT"""
+        out_rate, out_channels, out_width = self.OUTPUT_FORMAT
+        if width == 1:
+            pcm = audioop.bias(pcm, 1, -128) # 8 bits wav samples are unsigned
+        if width != out_width:
+            pcm = audioop.lin2lin(pcm, width, out_width)
+        if channels != out_channels:
+            if channels == 2 and out_channels == 1:
+                pcm = audioop.tomono(pcm, out_width, 0.5, 0.5)
+            elif channels == 1 and out_channels == 2:
+                pcm = audioop.tostereo(pcm, out_width, 1, 1)
+            else:
+                raise ValueError("unsupported number of channels: %d"%channels)
+        if rate != out_rate:
+            pcm, state = audioop.ratecv(pcm, out_width, out_channels, rate, out_rate, None)
+        return pcm
+
+    def __get_output(self):
+        """The long-lived player process (started on first use)"""
+        if self._output is None or self._output.poll() is not None:
+            rate, channels, width = self.OUTPUT_FORMAT
+            sample_format = {1: "S8", 2: "S16_LE", 3: "S24_3LE", 4: "S32_LE"}[width]
+            self._output = subprocess.Popen(
+                [self.player, "-q", "-t", "raw", "-f", sample_format, "-r", str(rate), "-c", str(channels), "--buffer-time=%d"%self.BUFFER_TIME],
+                stdin = subprocess.PIPE, stdout = self._devnull, stderr = self._devnull)
+        return self._output
+
+    def preload(self):
+        """Start the output process now, so that the first play() doesn't pay for it"""
+        if len(self.buffers) == 0:
+            return
+        try:
+            self.__get_output()
+        except Exception as e:
+            log.warning("AudioPlayer: unable to start %s (%s)"%(self.player, repr(e)))
+
+    def play(self, name):
+        """Play a clip without waiting (returns immediately), it cuts the clip being played"""
+        self.played_at[name] = time.time()
+        self._queue.put(name)
+
+    def close(self):
+        """Stop the writer thread and the output process"""
+        self._queue.put(None)
+        self._thread.join(1)
+        if self._output is not None:
+            try:
+                self._output.stdin.close()
+                self._output.terminate()
+            except Exception:
+                pass
+            self._output = None
+
+    def __run(self):
+        pcm = None          # clip being played
+        position = 0        # next byte of pcm to write
+        stream_start = 0    # time at which the data written since then started playing
+        written = 0.0       # duration of this data (s)
+        starting = None     # name of the clip whose first chunk is about to be written
+        lead = self.BUFFER_TIME / 1000000.0
+        while True:
+            # block only when there is nothing to play
+            try:
+                name = self._queue.get(pcm is None)
+            except Queue.Empty:
+                name = False
+            if name is None:
+                break
+            if name is not False:
+                pcm, position = self.__start(name)
+                if pcm is None:
+                    continue
+                starting = name
+            chunk = pcm[position:position + self._chunk_size]
+            position += len(chunk)
+            if position >= len(pcm):
+                pcm = None
+            now = time.time()
+            if stream_start + written < now:
+                # the output ran dry: the stream restarts now
+                stream_start, written = now, 0.0
+            try:
+                output = self.__get_output()
+                output.stdin.write(chunk)
+                output.stdin.flush()
+            except Exception as e:
+                log.warning("AudioPlayer: unable to play (%s)"%repr(e))
+                # the output process may be dead, it will be restarted on next play
+                pcm = None
+                continue
+            if starting is not None:
+                # the chunk is played after everything written before it
+                self.heard_at[starting] = stream_start + written
+                self.latency[starting] = self.heard_at[starting] - self.played_at[starting]
+                starting = None
+            written += len(chunk) / float(self._frame_size * self.OUTPUT_FORMAT[0])
+            # stay just ahead of the playback: a new clip is heard after what was already written
+            delay = stream_start + written - lead - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def __start(self, name):
+        """Returns (pcm, 0) to write the clip, or (None, 0) if it is played by a decoder process"""
+        if name in self.buffers:
+            return self.buffers[name], 0
+        try:
+            subprocess.Popen([self.decoder, "-q", self.clips[name]], stdout = self._devnull, stderr = self._devnull)
+        except Exception as e:
+            log.warning("AudioPlayer: unable to play %s (%s)"%(name, repr(e)))
+        return None, 0
+
+
+if __name__ == '__main__':
+    # Self-test: countdown beeps on 1s ticks (each longer than a tick) then the shutter,
+    # every clip must reach the speaker within MAX_LATENCY of its play() request
+    import sys
+    from constants import MP3S
+    logging.basicConfig(level = logging.DEBUG)
+    player = AudioPlayer(MP3S, *sys.argv[1:3]) # optional decoder and player commands
+    player.preload()
+    time.sleep(0.5)
+    latencies = []
+    for name in ["countdown", "countdown", "countdown", "shutter"]:
+        player.play(name)
+        time.sleep(1)
+        if name not in player.latency:
+            sys.exit("%s was not played"%name)
+        latencies.append(player.latency[name])
+        print "%s: heard %.1fms after play()"%(name, player.latency[name] * 1000)
+    player.close()
+    if max(latencies) > player.MAX_LATENCY:
+        sys.exit("latency too high: %.1fms > %.1fms"%(max(latencies) * 1000, player.MAX_LATENCY * 1000))
+    print "beep to speaker latency OK (< %.0fms)"%(player.MAX_LATENCY * 1000)
@@ -1,33 +1,139 @@
 import time
+import threading
 import numpy as np
 import cv2
 
+# capture properties moved from cv2.cv to cv2 in OpenCV 3
+try:
+    PROP_FRAME_WIDTH  = cv2.CAP_PROP_FRAME_WIDTH
+    PROP_FRAME_HEIGHT = cv2.CAP_PROP_FRAME_HEIGHT
+except AttributeError:
+    PROP_FRAME_WIDTH  = cv2.cv.CV_CAP_PROP_FRAME_WIDTH
+    PROP_FRAME_HEIGHT = cv2.cv.CV_CAP_PROP_FRAME_HEIGHT
+
 class Camera:
     '''
     Thin wrapper for the cv2 camera interface to make it look like a PiCamera
+
+    A grabber thread reads the device continuously and keeps the newest frame
+    in a preallocated buffer, so capture() is a copy of the current frame
+    instead of a read of a stale buffered one. The device resolution is only
+    renegotiated when self.resolution changes.
     '''
+    DEFAULT_RESOLUTION = (1600, 1200)
+
     def __init__(self):
         self.cam = cv2.VideoCapture(0)
-        time.sleep(.3) ## wait for auto adjust
         self.led = False
         self.previewing = False
-        
+        self.resolution = None
+        self._device_resolution = None
+        self._frame = None      # newest frame (BGR), swapped with _back by the grabber
+        self._back = None       # buffer the grabber reads into
+        self._frame_id = 0
+        self._condition = threading.Condition()
+        self._running = True
+        self._grabber = threading.Thread(target = self.__grab, name = "camera grabber")
+        self._grabber.daemon = True
+        self._grabber.start()
+        self.__wait_frame(timeout = 1) ## wait for the first frame
+
+    def __set_device_resolution(self):
+        resolution = tuple(self.resolution or self.DEFAULT_RESOLUTION)
+        if resolution == self._device_resolution:
+            return
+        self.cam.set(PROP_FRAME_WIDTH, resolution[0])
+        self.cam.set(PROP_FRAME_HEIGHT, resolution[1])
+        with self._condition:
+            self._device_resolution = resolution
+            # frames grabbed so far are at the former resolution
+            self._frame = None
+            self._back = None
+
+    def __grab(self):
+        while self._running:
+            self.__set_device_resolution()
+            if self._back is None:
+                ret, frame = self.cam.read()
+            else:
+                ret, frame = self.cam.read(self._back)
+            if not ret or frame is None:
+                time.sleep(0.01)
+                continue
+            with self._condition:
+                # frame becomes the current frame, the previous one is reused for next read
+                self._back = self._frame if (self._frame is not None and self._frame.shape == frame.shape) else None
+                self._frame = frame
+                self._frame_id += 1
+                self._condition.notify_all()
+
+    def __wait_frame(self, timeout = 2, after = 0):
+        """(id, copy) of the newest frame grabbed at the current resolution, (None, None) on timeout
+
+        after: only return a frame grabbed after the frame of that id
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._frame is None or self._frame_id <= after or self._device_resolution != tuple(self.resolution or self.DEFAULT_RESOLUTION):
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._running:
+                    return None, None
+                self._condition.wait(remaining)
+            return self._frame_id, self._frame.copy()
+
     def start_preview(self):
         pass
-            
+
     def stop_preview(self):
         self.previewing = False
-        
-    def capture(self, filename, resize=None):
+
+    def capture(self, filename, format=None, resize=None):
         '''
         resize not supported
+        filename may also be a writable stream, then format is 'rgb' or 'jpeg'
+        (raw 'rgb' frames are scaled to self.resolution if the device didn't match it)
         '''
-        self.cam.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, 1600)
-        self.cam.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT,1200)
-        ret, frame = self.cam.read()
-        cv2.imwrite(filename, frame)
-        
+        self.__capture(filename, format)
+
+    def __capture(self, filename, format = None, after = 0):
+        frame_id, frame = self.__wait_frame(after = after)
+        if frame is None:
+            raise IOError("no frame from the camera")
+        if format == 'rgb':
+            if self.resolution is not None and frame.shape[1::-1] != tuple(self.resolution):
+                frame = cv2.resize(frame, tuple(self.resolution))
+            filename.write(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).tobytes())
+        elif format is not None:
+            ret, data = cv2.imencode('.jpg', frame)
+            filename.write(data.tobytes())
+        else:
+            cv2.imwrite(filename, frame)
+        return frame_id
+
+    def capture_continuous(self, output, format=None, use_video_port=False):
+        '''
+        Generator capturing a frame at each iteration (see PiCamera.capture_continuous)
+        output is a filename pattern ('frame-{counter:03d}.jpg') or a writable stream
+        Each iteration waits for a frame newer than the previous one
+        '''
+        counter = 1
+        frame_id = 0
+        while True:
+            if isinstance(output, str):
+                filename = output.format(counter=counter)
+                frame_id = self.__capture(filename, after = frame_id)
+                yield filename
+            else:
+                frame_id = self.__capture(output, format, after = frame_id)
+                yield output
+            counter += 1
+
     def close(self):
+        self._running = False
+        with self._condition:
+            self._condition.notify_all()
+        self._grabber.join(1)
+        self.cam.release()
         del self.cam
 
 PiCamera = Camera
@@ -0,0 +1,149 @@
+'''
+    In-memory capture helpers
+
+    Frames go from the camera to a PIL Image through a raw RGB buffer:
+    no JPEG is encoded by the camera, decoded back, or written to the SD card
+    before the final picture is saved.
+'''
+import io
+import time
+from PIL import Image, ImageFilter, ImageStat
+import logging
+log = logging.getLogger(__name__)
+
+
+def padded_size(size):
+    """Size of a raw capture: picamera pads width to 32 and height to 16"""
+    return (int((size[0] + 31) / 32) * 32, int((size[1] + 15) / 16) * 16)
+
+
+def _to_image(data, size):
+    """PIL RGB Image of the given size from a raw (possibly padded) rgb capture"""
+    width, height = size
+    if len(data) == width * height * 3:
+        return Image.frombuffer('RGB', (width, height), data, 'raw', 'RGB', 0, 1).copy()
+    # padded raw capture: crop the padding out
+    image = Image.frombuffer('RGB', padded_size((width, height)), data, 'raw', 'RGB', 0, 1)
+    return image.crop((0, 0, width, height))
+
+
+def capture_image(camera, stream = None):
+    """Capture a frame into memory
+
+    Arguments:
+        camera : a picamera.PiCamera, Camera.Camera or fakehardware.PiCamera object
+        stream (io.BytesIO, opt) : buffer to reuse between captures
+
+    returns: a PIL RGB Image of size camera.resolution
+    """
+    if stream is None:
+        stream = io.BytesIO()
+    stream.seek(0)
+    stream.truncate()
+    camera.capture(stream, format = 'rgb')
+    return _to_image(stream.getvalue(), camera.resolution)
+
+
+def capture_frames(camera, count, fps, stream = None):
+    """Capture a sequence of frames at a fixed rate into memory
+
+    Frames come from camera.capture_continuous (video port when available),
+    one every 1/fps second: the loop sleeps until the slot of each frame,
+    so the rate doesn't depend on how fast the camera delivers them.
+
+    Arguments:
+        camera : a picamera.PiCamera, Camera.Camera or fakehardware.PiCamera object
+        count (int) : number of frames
+        fps (float) : target frame rate (None: as fast as the camera goes)
+        stream (io.BytesIO, opt) : buffer to reuse between captures
+
+    returns: (frames, achieved frame rate), frames is a list of PIL RGB Images of size camera.resolution
+    """
+    if stream is None:
+        stream = io.BytesIO()
+    stream.seek(0)
+    stream.truncate()
+    frames = []
+    start = time.time()
+    for i, output in enumerate(camera.capture_continuous(stream, format = 'rgb', use_video_port = True)):
+        frames.append(_to_image(stream.getvalue(), camera.resolution))
+        stream.seek(0)
+        stream.truncate()
+        if i + 1 == count:
+            break
+        if fps is not None:
+            delay = start + (i + 1) / float(fps) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    elapsed = time.time() - start
+    achieved = fps
+    if elapsed > 0 and count > 1:
+        achieved = (count - 1) / elapsed
+    log.debug("capture_frames: %d frames at %.1ffps (target %s)"%(count, achieved, repr(fps)))
+    return frames, achieved
+
+
+# Laplacian: its variance is high for sharp pictures, low for blurred (moving) ones
+_LAPLACIAN = ImageFilter.Kernel((3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale = 1, offset = 128)
+
+
+def frame_score(image, width = 160):
+    """Quality score of a frame: sharpness weighted by exposure (higher is better)
+
+    Computed on a grayscale copy downscaled to width, so it only takes a few
+    milliseconds whatever the capture size.
+    """
+    height = max(1, image.size[1] * width // image.size[0])
+    small = image.resize((width, height), Image.BOX).convert('L')
+    sharpness = ImageStat.Stat(small.filter(_LAPLACIAN)).var[0]
+    stat = ImageStat.Stat(small)
+    # 1 for a mid-gray mean, 0 for a black or white picture
+    exposure = 1.0 - abs(stat.mean[0] - 128) / 128.0
+    # share of the pixels that are burnt out or blocked up
+    histogram = stat.h
+    clipped = float(sum(histogram[:5]) + sum(histogram[251:])) / stat.count[0]
+    return sharpness * exposure * (1.0 - clipped)
+
+
+def best_frame(frames):
+    """Index of the best frame of a burst (see frame_score) and the scores of all frames"""
+    scores = [frame_score(frame) for frame in frames]
+    return scores.index(max(scores)), scores
+
+
+if __name__ == '__main__':
+    # Benchmark: collage through JPEG files (former path) vs in-memory capture
+    import os
+    import tempfile
+    import shutil
+    import fakehardware
+    from constants import MODE_PARAMETERS
+
+    camera = fakehardware.PiCamera()
+    w, h = camera.resolution = MODE_PARAMETERS['collage']['snap_size']
+    tmp_dir = tempfile.mkdtemp()
+    runs = 5
+    try:
+        start = time.time()
+        for run in range(runs):
+            tiles = [os.path.join(tmp_dir, 'collage_%d.jpg'%i) for i in range(3)]
+            for tile in tiles:
+                camera.capture(tile)
+            snapshot = Image.new('RGB', (w * 2, h * 2))
+            for tile, box in zip(tiles, [(0, 0), (w, 0), (0, h)]):
+                snapshot.paste(Image.open(tile), box)
+            snapshot.save(os.path.join(tmp_dir, 'collage.jpg'))
+        disk = (time.time() - start) / runs
+
+        start = time.time()
+        stream = io.BytesIO()
+        for run in range(runs):
+            snapshot = Image.new('RGB', (w * 2, h * 2))
+            for box in [(0, 0), (w, 0), (0, h)]:
+                snapshot.paste(capture_image(camera, stream), box)
+            snapshot.save(os.path.join(tmp_dir, 'collage.jpg'))
+        memory = (time.time() - start) / runs
+    finally:
+        shutil.rmtree(tmp_dir)
+    print "collage through jpeg files: %.1fms" % (disk * 1000)
+    print "collage in memory:          %.1fms (%.1fms saved)" % (memory * 1000, (disk - memory) * 1000)
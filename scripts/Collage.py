@@ -0,0 +1,60 @@
+'''
+    Incremental collage assembly
+
+    Each tile is handed to the post-processing pool as soon as it is captured,
+    and composited with the matching region of the foreground frame while the
+    countdown of the next tile runs. Only the assembly of the composited tiles
+    and the JPEG encoding remain once the last shot is taken.
+'''
+import logging
+log = logging.getLogger(__name__)
+
+
+class CollageBuilder:
+    """Assembles a collage tile by tile in a PostProcessing.PostProcessor"""
+    def __init__(self, processor, tile_size, positions, foreground = None):
+        """Create the collage
+
+        Arguments:
+            processor             : the PostProcessing.PostProcessor doing the work
+            tile_size tupple(w,h) : size of each tile
+            positions (list)      : (x, y) position of each tile, in capture order
+                                    (at most one tile per slot of the processor)
+            foreground (str, opt) : frame image file to paste on top of the collage
+        """
+        self.processor = processor
+        self.tile_size = tile_size
+        self.positions = positions
+        w, h = tile_size
+        self.size = (max([x for (x, y) in positions]) + w, max([y for (x, y) in positions]) + h)
+        self.foreground = None
+        if foreground is not None:
+            self.foreground = (foreground, self.size)
+        self._tiles = []
+        self._results = []
+
+    def add(self, tile):
+        """Queue the next captured tile (PIL Image) for compositing, returns immediately"""
+        index = len(self._tiles)
+        if index >= len(self.positions):
+            raise ValueError("collage already has %d tiles"%len(self.positions))
+        x, y = self.positions[index]
+        box = (x, y, x + self.tile_size[0], y + self.tile_size[1])
+        self._results.append(self.processor.composite_tile(index, tile, box, self.foreground))
+        self._tiles.append((index, box))
+        log.debug("CollageBuilder: tile %d queued"%(index + 1))
+
+    def finish(self, filename):
+        """Assemble and encode the collage once all tiles are composited
+
+        Arguments:
+            filename (str) : where to save the collage as JPEG
+
+        returns: a PostProcessing.PostProcessResult, its result is filename
+        """
+        return self.processor.encode(filename, self.size, self._tiles, self.foreground, wait_for = self._results)
+
+    def cancel(self):
+        """Drop the collage (tiles being composited are ignored)"""
+        self._tiles = []
+        self._results = []
@@ -0,0 +1,108 @@
+'''
+    Non-blocking countdown driven by the Tk scheduler
+
+    Ticks and the final callback are scheduled with root.after() against
+    wall-clock deadlines computed once at start, so the Tk main loop keeps
+    running during the countdown and the end fires on time, whatever the
+    tick callbacks cost.
+'''
+import math
+import time
+from Tkinter import IntVar
+import logging
+log = logging.getLogger(__name__)
+
+
+class Countdown:
+    """A cancellable countdown scheduled with root.after()"""
+    def __init__(self, root, duration, on_tick = None, on_done = None, period = 1.0):
+        """Create the countdown (call start() to launch it)
+
+        Arguments:
+            root (Tk widget) : widget used to schedule the callbacks
+            duration (s)     : length of the countdown
+            on_tick          : function on_tick(remaining) called every period, remaining in seconds
+            on_done          : function on_done() called at the deadline (not called if cancelled)
+            period (s)       : interval between two ticks
+        """
+        self.root = root
+        self.duration = duration
+        self.on_tick = on_tick
+        self.on_done = on_done
+        self.period = period
+        self.start_time = None
+        self.deadline = None
+        self.completed = False
+        self.cancelled = False
+        self._tick_index = 0
+        self._ticks = int(math.ceil(float(duration) / period))
+        self._after_id = None
+        self._finished_var = None
+
+    def start(self):
+        """Start the countdown, the first tick is immediate"""
+        self.start_time = time.time()
+        self.deadline = self.start_time + self.duration
+        self._tick_index = 0
+        self.__tick()
+
+    def cancel(self):
+        """Cancel the countdown, on_done won't be called"""
+        if self.completed or self.cancelled:
+            return
+        log.info("Countdown cancelled")
+        self.cancelled = True
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        self.__finished()
+
+    def running(self):
+        """True between start() and the end (or cancellation) of the countdown"""
+        return self.start_time is not None and not (self.completed or self.cancelled)
+
+    def wait(self):
+        """Start the countdown and wait for its end while still processing Tk events
+
+        returns: True if the countdown completed, False if it was cancelled
+        """
+        self._finished_var = IntVar(self.root, value = 0)
+        self.start()
+        if self.running():
+            self.root.wait_variable(self._finished_var)
+        return self.completed
+
+    def __schedule(self, target, callback):
+        delay_ms = int(round((target - time.time()) * 1000))
+        self._after_id = self.root.after(max(0, delay_ms), callback)
+
+    def __tick(self):
+        self._after_id = None
+        if self.cancelled:
+            return
+        if self._tick_index < self._ticks:
+            target = self.start_time + self._tick_index * self.period
+            if target > time.time() + 0.001:
+                # woke up early: re-arm for the exact deadline
+                self.__schedule(target, self.__tick)
+                return
+            if self.on_tick is not None:
+                self.on_tick(self.deadline - target)
+                if self.cancelled:
+                    return
+            self._tick_index += 1
+            if self._tick_index < self._ticks:
+                self.__schedule(self.start_time + self._tick_index * self.period, self.__tick)
+                return
+        if self.deadline > time.time() + 0.001:
+            self.__schedule(self.deadline, self.__tick)
+            return
+        log.debug("Countdown: done %.1fms after deadline"%((time.time() - self.deadline) * 1000))
+        self.completed = True
+        if self.on_done is not None:
+            self.on_done()
+        self.__finished()
+
+    def __finished(self):
+        if self._finished_var is not None:
+            self._finished_var.set(1)
@@ -1,7 +1,15 @@
 '''
     Basic interface for hardware buttons
     Laurent Alacoque 2o18
+
+    Buttons can be polled with state(), or, in event mode, edges are detected
+    by RPi.GPIO callbacks, debounced and queued with their timestamp; a byte
+    is written to a pipe (see fileno()) so that the Tk loop only wakes up
+    when a button is actually pressed.
 '''
+import os
+import time
+import threading
 
 RPI_GPIO_EXISTS = True
 
@@ -24,13 +32,16 @@ except ImportError:
 class HardwareButtons():
     """Hardware Buttons wrapper class"""
     
-    def __init__(self, buttons_pins=BUTTONS_PINS, mode=BUTTONS_MODE, active_state=BUTTON_IS_ACTIVE):
+    def __init__(self, buttons_pins=BUTTONS_PINS, mode=BUTTONS_MODE, active_state=BUTTON_IS_ACTIVE, event_driven=False, debounce=200):
         """Constructor for Buttons
         
         Arguments:
             button_pins [list(int)]         : list of GPIO pins
             mode ["pull_up" or "pull_down"] : the pull state of the GPIO
             active_state [0 or 1]           : GPIO status when activated
+            event_driven [bool]             : detect presses with edge callbacks instead of polling
+                                              (falls back to polling if edge detection is unavailable)
+            debounce [ms]                   : edges closer than this to the last press of a button are ignored
         
         Note: this is safe to use this class on systems that don't have GPIO module
             in this case, has_buttons() methods returns False
@@ -39,7 +50,13 @@ class HardwareButtons():
 
             
         self.active_state = active_state
+        self.debounce = debounce / 1000.0
         self._has_buttons = False
+        self._events_enabled = False
+        self._events = []
+        self._events_lock = threading.Lock()
+        self._last_press = {}
+        self._pipe = None
         if RPI_GPIO_EXISTS:
             if mode == "pull_up":
                 self.mode = GPIO.PUD_UP
@@ -54,11 +71,71 @@ class HardwareButtons():
                 self._has_buttons = True
             else:
                 self._has_buttons = False
+            if self._has_buttons and event_driven:
+                self.__enable_events()
+
+    def __enable_events(self):
+        if self.active_state == 1:
+            edge = GPIO.RISING
+        else:
+            edge = GPIO.FALLING
+        try:
+            for pin in self.buttons_pins:
+                GPIO.add_event_detect(pin, edge, callback = self._on_edge)
+        except RuntimeError:
+            # edge detection unavailable: keep polling
+            for pin in self.buttons_pins:
+                try:
+                    GPIO.remove_event_detect(pin)
+                except RuntimeError:
+                    pass
+            return
+        self._pipe = os.pipe()
+        self._events_enabled = True
     
     def __del__(self):
         """Cleanup GPIO"""
         if self._has_buttons:
             GPIO.cleanup()
+        if self._pipe is not None:
+            os.close(self._pipe[0])
+            os.close(self._pipe[1])
+
+    def _on_edge(self, pin):
+        """Edge callback (called from the RPi.GPIO thread): debounce and queue the press"""
+        now = time.time()
+        if now - self._last_press.get(pin, 0) < self.debounce:
+            return
+        if not self._is_active(pin):
+            # glitch: the pin is not in the active state anymore
+            return
+        self._last_press[pin] = now
+        with self._events_lock:
+            self._events.append((self.buttons_pins.index(pin) + 1, now))
+        os.write(self._pipe[1], "!")
+
+    def _is_active(self, pin):
+        return GPIO.input(pin) == self.active_state
+
+    def events_enabled(self):
+        """Wether presses are detected by edge callbacks (otherwise, poll state())"""
+        return self._events_enabled
+
+    def fileno(self):
+        """File descriptor that becomes readable when a press is queued (event mode only)"""
+        return self._pipe[0]
+
+    def get_events(self):
+        """Pop the queued presses (event mode only)
+
+        returns: a list of (i, timestamp) where i is the button index (as in state())
+            and timestamp the time.time() of the press, oldest first
+        """
+        os.read(self._pipe[0], 512)
+        with self._events_lock:
+            events = self._events
+            self._events = []
+        return events
             
     def has_buttons(self):
         """Wether buttons were configured
@@ -102,7 +179,7 @@ class HardwareButtons():
 if __name__ == '__main__':
     import time
     import sys
-    buttons = HardwareButtons()
+    buttons = HardwareButtons(event_driven = "--events" in sys.argv)
     last = 0
     if buttons.has_buttons():
         print "Press hardware buttons to see change, ctrl+C to exit"
@@ -111,6 +188,14 @@ if __name__ == '__main__':
         print "Number of buttons is %d" % buttons.buttons_number()
         sys.exit()
         
+    if buttons.events_enabled():
+        import select
+        print "Event mode"
+        while True:
+            select.select([buttons.fileno()], [], [])
+            for button, timestamp in buttons.get_events():
+                print "button %d pressed (%.1fms ago)"%(button, (time.time() - timestamp) * 1000)
+
     while True:
         state = buttons.state()
         if last != state:
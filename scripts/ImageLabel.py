@@ -7,23 +7,68 @@ Thanks!
 '''
 from Tkinter import *
 from PIL import ImageTk,Image
-from itertools import count
+from collections import OrderedDict, deque
+import os
 import logging
 log = logging.getLogger(__name__)
 
 class ImageLabel(Label):
     """a label containing and image"""
-    def __init__(self, Tk_root, size = None):
+    def __init__(self, Tk_root, size = None, renditions = 4, buffered_frames = 8):
         """Create the image label
         
         Arguments:
-            Tk_root (Tk widget) : parent object
-            size    tupple(w,h) : image max dimensions
+            Tk_root (Tk widget)    : parent object
+            size    tupple(w,h)    : image max dimensions
+            renditions (int)       : number of resized still images kept for instant redisplay
+            buffered_frames (int)  : number of animation frames decoded ahead of the one displayed
         """
         Label.__init__(self, Tk_root)
         self.size = size
         self.root = Tk_root # for update()
+        self.frames = None
+        self.renditions = OrderedDict() # (path, mtime, size) -> PhotoImage, least recently used first
+        self.max_renditions = renditions
+        self.buffered_frames = buffered_frames
+        self._animation = None # the animated PIL Image being played
+        self._after_id = None
         log.debug("Created ImageLabel with size %s"%repr(size))
+
+    def __fit(self, size):
+        """Size of an image of the given size once fit to self.size"""
+        w,h = size
+        #compute resize ratio (fit image to size)
+        ratio = 1.0
+        if self.size is not None:
+            ratio = max([ float(w)/self.size[0], float(h)/self.size[1]])
+        return ( int(w/ratio), int(h/ratio) )
+
+    def __stop(self):
+        """Stop a running animation"""
+        if self._after_id is not None:
+            self.after_cancel(self._after_id)
+            self._after_id = None
+        self._animation = None
+
+    def __load_still(self, path, im):
+        """Display a still image, from the renditions cache if possible"""
+        key = None
+        if path is not None:
+            key = (os.path.abspath(path), os.path.getmtime(path), self.size)
+        photo = self.renditions.pop(key, None)
+        if photo is None:
+            target = self.__fit(im.size)
+            # JPEG: let the decoder downscale (1/2, 1/4, 1/8) to the closest size above target
+            im.draft('RGB', target)
+            photo = ImageTk.PhotoImage(im.resize(target, Image.ANTIALIAS))
+        else:
+            log.debug("Rendition of %s found in cache"%path)
+        if key is not None:
+            self.renditions[key] = photo
+            while len(self.renditions) > self.max_renditions:
+                self.renditions.popitem(last = False)
+        self.frames = [photo]
+        self.config(image = photo)
         
     def load(self, im):
         """Load a new image in the ImageLabel
@@ -32,53 +77,56 @@ class ImageLabel(Label):
             im (path or PIL Image) : the image or image file to be loaded
         """
         log.debug("Loading image %s",repr(im))
+        self.__stop()
+        path = None
         if isinstance(im, str):
+            path = im
             im = Image.open(im)
-        self.loc = 0
-        self.frames = []
-        w,h = im.size
-        #compute resize ratio (fit image to size)
-        ratio = 1.0
-        if self.size is not None:
-            ratio = max([ float(w)/self.size[0], float(h)/self.size[1]])
-        try:
-            for i in count(1):
-                temp_frame = im.copy()
-                temp_frame = temp_frame.resize(( int(w/ratio), int(h/ratio) ))
-                self.frames.append(ImageTk.PhotoImage(temp_frame))
-                if i == 1:
-                    #immediately load first frame
-                    self.config(image = self.frames[0])
-                    self.root.update()
-                im.seek(i)
-        except EOFError:
-            pass
+        if not getattr(im, 'is_animated', False):
+            self.__load_still(path, im)
+            return
+        # Animations are streamed: frames are decoded just ahead of the playhead
+        # into a ring buffer, so memory doesn't depend on the animation length
+        self._animation = im
+        self._target = self.__fit(im.size)
+        self.frames = deque()
+        self.__decode_frame()
+        self.next_frame()
 
+    def __decode_frame(self):
+        """Decode the next frame of the animation (looping) at the end of the buffer"""
+        im = self._animation
+        frame = im.convert('RGBA').resize(self._target)
+        self.frames.append((ImageTk.PhotoImage(frame), im.info.get('duration', 100) or 100))
         try:
-            self.delay = im.info['duration']
-        except:
-            self.delay = 100
+            im.seek(im.tell() + 1)
+        except EOFError:
+            im.seek(0)
 
-        if len(self.frames) == 1:
-            self.config(image = self.frames[0])
-        else:
-            self.next_frame()
+    def __fill_buffer(self, max_frames = 2):
+        """Decode up to max_frames frames if the buffer isn't full (the buffer fills up while playing)"""
+        for i in range(max_frames):
+            if self._animation is None or len(self.frames) >= self.buffered_frames:
+                break
+            self.__decode_frame()
 
     def unload(self):
         """Remove the image"""
         log.debug("Unloading image")
+        self.__stop()
         self.config(image = "")
         self.frames = None
         self.root.update()
 
     def next_frame(self):
         """Skip to next frame (for animated gifs)"""
-        if self.frames:
-            self.loc += 1
-            self.loc %= len(self.frames)
-            self.config(image = self.frames[self.loc])
-            self.root.update()
-            self.after(self.delay, self.next_frame)
+        if self.frames and self._animation is not None:
+            photo, duration = self.frames.popleft()
+            self.config(image = photo)
+            self._current = photo # keep a reference while displayed
+            self._after_id = self.after(duration, self.next_frame)
+            # decode ahead once the next frame is scheduled
+            self.__fill_buffer()
             
 if __name__ == '__main__':
 
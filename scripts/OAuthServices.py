@@ -7,8 +7,16 @@
     - Update Jan 2019: Moving to photoslibrary API (Picasa API is now deprecated)
 """
 import os
+import json
 import base64
+import hashlib
+import time
+import random
+import tempfile
+import threading
+import Queue
 from apiclient import errors, discovery
+from email.generator import Generator
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import mimetypes
@@ -18,7 +26,10 @@ from email.mime.base import MIMEBase
 import webbrowser
 from datetime import datetime, timedelta
 from googleapiclient.discovery import build
+from googleapiclient.discovery_cache.base import Cache
+from googleapiclient.http import MediaFileUpload
 from httplib2 import Http
+import httplib2
 from oauth2client import file, client, tools
 from googleapiclient.errors import HttpError
 
@@ -26,9 +37,285 @@ import logging
 log = logging.getLogger(__name__)
 
 
+class DiscoveryFileCache(Cache):
+    """On-disk cache for the discovery documents of Google APIs
+
+    Building a service client normally downloads its discovery document;
+    with this cache it is only fetched once every max_age seconds.
+    """
+    def __init__(self, directory, max_age = 7 * 24 * 3600):
+        """Create the cache
+
+        Arguments:
+            directory (str) : where discovery documents are stored (created if needed)
+            max_age (s)     : age after which a cached document is fetched again
+        """
+        self.directory = directory
+        self.max_age = max_age
+
+    def __path(self, url):
+        return os.path.join(self.directory, hashlib.md5(url.encode('utf-8')).hexdigest() + ".json")
+
+    def get(self, url):
+        path = self.__path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, 'r') as cache_file:
+                log.debug("DiscoveryFileCache: using cached discovery document for %s"%url)
+                return cache_file.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, url, content):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = self.__path(url)
+            with open(path + ".tmp", 'w') as cache_file:
+                cache_file.write(content)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            log.warning("DiscoveryFileCache: unable to cache discovery document for %s (%s)"%(url, str(e)))
+
+
+class HttpPool:
+    """Thread-safe pool of keep-alive httplib2.Http objects
+
+    httplib2.Http keeps its connections open between requests (one per host)
+    but can't be used by two threads at once. The pool lends an idle Http to
+    each request, the most recently used first so that its connection to the
+    host is still warm, and creates new ones (up to size) when all are busy.
+    Use view() to get an Http-like object that credentials.authorize() and
+    googleapiclient accept.
+    """
+    def __init__(self, size = 4, timeout = 60):
+        """Create the pool
+
+        Arguments:
+            size (int)    : maximum number of simultaneous requests (and of Http objects)
+            timeout (s)   : socket timeout of the connections
+        """
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._created = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.requests = 0   # requests made through the pool
+        self.reused = 0     # requests sent on an already open connection
+
+    def __acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        http = Http(timeout = self.timeout)
+        try:
+            # 308 is used by the resumable upload protocols, it isn't a redirect
+            http.redirect_codes = http.redirect_codes - set([308])
+        except AttributeError:
+            pass
+        return http
+
+    def __release(self, http):
+        with self._lock:
+            self._idle.append(http)
+        self._slots.release()
+
+    def request(self, uri, method = "GET", body = None, headers = None, redirections = httplib2.DEFAULT_MAX_REDIRECTS, connection_type = None):
+        """Same as httplib2.Http.request, on a pooled Http object"""
+        http = self.__acquire()
+        try:
+            scheme, authority = httplib2.urlnorm(uri)[:2]
+            connection = http.connections.get(scheme + ":" + authority)
+            with self._lock:
+                self.requests += 1
+                if connection is not None and getattr(connection, "sock", None) is not None:
+                    self.reused += 1
+            return http.request(uri, method, body, headers, redirections, connection_type)
+        finally:
+            self.__release(http)
+
+    def view(self):
+        """A new Http-like object sending its requests through the pool
+
+        Each view can be authorized separately: credentials.authorize() replaces
+        the request method of the view, not of the pool.
+        """
+        return _PooledHttp(self)
+
+    def stats(self):
+        """Usage of the pool: dict of requests, reused (connections), reuse_rate and http_objects"""
+        with self._lock:
+            rate = 0.0
+            if self.requests != 0:
+                rate = float(self.reused) / self.requests
+            return {"requests": self.requests, "reused": self.reused, "reuse_rate": rate, "http_objects": self._created}
+
+    def close(self):
+        """Close the idle connections"""
+        with self._lock:
+            for http in self._idle:
+                for connection in http.connections.values():
+                    connection.close()
+                http.connections = {}
+
+
+class _PooledHttp(object):
+    """Http-like view of an HttpPool (see HttpPool.view)"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.timeout = pool.timeout
+        self.redirect_codes = httplib2.REDIRECT_CODES - set([308])
+
+    def request(self, *args, **kwargs):
+        return self.pool.request(*args, **kwargs)
+
+    def close(self):
+        pass
+
+
+class ResumableUpload:
+    """Chunked upload of a file with the resumable protocol of the uploads endpoint
+
+    The file is streamed from disk chunk by chunk. The session URL and the
+    confirmed offset are recorded in a small json file in session_dir, so an
+    interrupted upload (dropped connection, crash, reboot) continues where it
+    stopped instead of restarting from byte zero.
+    """
+    def __init__(self, http, url, filename, session_dir, chunk_size = 1024 * 1024, mime_type = None):
+        """Prepare the upload (nothing is sent before run())
+
+        Arguments:
+            http (httplib2.Http) : (authorized) http object used for the requests
+            url (str)            : upload endpoint
+            filename (str)       : path to the file to upload
+            session_dir (str)    : where upload sessions are recorded (created if needed)
+            chunk_size (int)     : bytes sent per request (rounded to the server granularity)
+            mime_type (str)      : content type of the file (guessed from filename if None)
+        """
+        self.http = http
+        self.url = url
+        self.filename = filename
+        self.session_dir = session_dir
+        self.chunk_size = chunk_size
+        self.mime_type = mime_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.size = os.path.getsize(filename)
+        # a modified file gets a new session
+        key = "%s|%d|%d"%(os.path.abspath(filename), self.size, int(os.path.getmtime(filename)))
+        self.session_file = os.path.join(session_dir, hashlib.md5(key.encode('utf-8')).hexdigest() + ".json")
+        self.session_url = None
+        self.offset = 0
+
+    def __load_session(self):
+        try:
+            with open(self.session_file, 'r') as session:
+                state = json.load(session)
+            self.session_url = str(state["url"])
+            self.offset = state["offset"]
+            self.chunk_size = state["chunk_size"]
+        except (IOError, OSError, ValueError, KeyError):
+            self.session_url = None
+            self.offset = 0
+
+    def __save_session(self):
+        if not os.path.isdir(self.session_dir):
+            os.makedirs(self.session_dir)
+        with open(self.session_file + ".tmp", 'w') as session:
+            json.dump({"url": self.session_url, "offset": self.offset, "chunk_size": self.chunk_size, "filename": self.filename}, session)
+        os.rename(self.session_file + ".tmp", self.session_file)
+
+    def __remove_session(self):
+        try:
+            os.remove(self.session_file)
+        except OSError:
+            pass
+        self.session_url = None
+        self.offset = 0
+
+    def __start(self):
+        headers = {
+            'Content-Length': '0',
+            'X-Goog-Upload-Command': 'start',
+            'X-Goog-Upload-Content-Type': self.mime_type,
+            'X-Goog-Upload-File-Name': os.path.basename(self.filename),
+            'X-Goog-Upload-Protocol': 'resumable',
+            'X-Goog-Upload-Raw-Size': str(self.size),
+        }
+        (response, content) = self.http.request(self.url, method="POST", body="", headers=headers)
+        if response.status != 200 or not ('x-goog-upload-url' in response):
+            raise IOError("Error starting upload session on %s (%d)"%(self.url, response.status))
+        self.session_url = response['x-goog-upload-url']
+        granularity = int(response.get('x-goog-upload-chunk-granularity', 1))
+        self.chunk_size = max(granularity, (self.chunk_size // granularity) * granularity)
+        self.offset = 0
+        self.__save_session()
+        log.debug("ResumableUpload: started session for %s (%d bytes, chunks of %d)"%(self.filename, self.size, self.chunk_size))
+
+    def __query(self):
+        """Ask the server how many bytes it received, returns False if the session is gone"""
+        headers = {'Content-Length': '0', 'X-Goog-Upload-Command': 'query'}
+        (response, content) = self.http.request(self.session_url, method="POST", body="", headers=headers)
+        if response.status != 200 or response.get('x-goog-upload-status') != 'active':
+            log.warning("ResumableUpload: session for %s is not active anymore (%d)"%(self.filename, response.status))
+            return False
+        self.offset = int(response.get('x-goog-upload-size-received', 0))
+        self.__save_session()
+        log.info("ResumableUpload: resuming %s at offset %d/%d"%(self.filename, self.offset, self.size))
+        return True
+
+    def run(self):
+        """Upload the (remaining part of the) file
+
+        returns: the upload token
+        raises: IOError on failure (the session is kept, call run() again to resume)
+        """
+        self.__load_session()
+        if self.session_url is None or not self.__query():
+            self.__start()
+        with open(self.filename, "rb") as image_file:
+            image_file.seek(self.offset)
+            while True:
+                chunk = image_file.read(self.chunk_size)
+                last = self.offset + len(chunk) >= self.size
+                headers = {
+                    'Content-Length': str(len(chunk)),
+                    'X-Goog-Upload-Command': 'upload, finalize' if last else 'upload',
+                    'X-Goog-Upload-Offset': str(self.offset),
+                }
+                (response, content) = self.http.request(self.session_url, method="POST", body=chunk, headers=headers)
+                if response.status != 200:
+                    raise IOError("Error uploading %s at offset %d (%d)"%(self.filename, self.offset, response.status))
+                self.offset += len(chunk)
+                if last:
+                    self.__remove_session()
+                    log.debug("ResumableUpload: %s uploaded with id:[%s]"%(self.filename, content))
+                    return content
+                self.__save_session()
+
+
 class OAuthServices:
     """Unique entry point for Google Services authentication"""
-    def __init__(self, client_secret, credentials_store, username, enable_upload = True, enable_email = True, log_level = logging.WARNING):
+    UPLOAD_URL = 'https://photoslibrary.googleapis.com/v1/uploads'
+
+    # token manager (see start_token_manager): the token is refreshed
+    # TOKEN_REFRESH_LEAD + [0, TOKEN_REFRESH_JITTER] seconds before it expires
+    TOKEN_REFRESH_LEAD      = 300
+    TOKEN_REFRESH_JITTER    = 60
+    TOKEN_RETRY_DELAY       = 30    # first delay before retrying a failed refresh (doubles each time)
+    TOKEN_MAX_RETRY_DELAY   = 600
+
+    # album listing (see iter_user_albums)
+    ALBUM_PAGE_SIZE         = 50    # maximum accepted by albums.list
+    ALBUM_CACHE_MAX_AGE     = 3600  # a cached listing younger than this is used without asking the server
+    ALBUM_CACHE_MAX_STALE   = 86400 # an older one is revalidated with its first page, up to this age
+
+    def __init__(self, client_secret, credentials_store, username, enable_upload = True, enable_email = True, log_level = logging.WARNING, discovery_cache_dir = None,
+                 resumable_upload = True, upload_chunk_size = 1024 * 1024, upload_session_dir = None,
+                 email_rendition_size = 1600, email_rendition_quality = 85, http_pool_size = 4, http_timeout = 60,
+                 album_cache_file = None):
         """Create an OAuthService provider
         
         Arguments:
@@ -38,6 +325,19 @@ class OAuthServices:
             enable_email             : enable send_email feature
             enable_upload            : enable upload pictures feature
             log_level                : level of logging (integer, see python module logging)     
+            discovery_cache_dir      : where to cache the APIs discovery documents
+                                       (defaults to a 'discovery_cache' directory next to credentials_store)
+            resumable_upload         : upload pictures by chunks with the resumable protocol
+            upload_chunk_size        : size of the chunks for resumable uploads (bytes)
+            upload_session_dir       : where resumable upload sessions are recorded
+                                       (defaults to an 'upload_sessions' directory next to credentials_store)
+            email_rendition_size     : JPEG pictures are emailed downscaled to fit this size (longest side, pixels)
+                                       None to email the original file
+            email_rendition_quality  : JPEG quality of the emailed pictures
+            http_pool_size           : number of keep-alive connections shared by all the requests to Google
+            http_timeout             : socket timeout of these connections (s)
+            album_cache_file         : where the album listings are cached (see iter_user_albums)
+                                       (defaults to 'album_cache.json' next to credentials_store)
         """
         self.client_secret = client_secret
         self.credentials_store = None
@@ -45,6 +345,36 @@ class OAuthServices:
         self.enable_upload = enable_upload
         self.enable_email  = enable_email
         self.scopes = ""
+
+        # long-lived objects, built on first use
+        # (shared by the UI thread and the upload worker, hence the lock)
+        self._lock = threading.RLock()
+        self.http_pool = HttpPool(http_pool_size, http_timeout)
+        self._credentials = None
+        self._access_token = None
+        self._signed_in = False
+        self.auth_changed = threading.Event() # set by the token manager when signed_in() changes
+        self._token_thread = None
+        self._token_stop = threading.Event()
+        self._photo_client = None
+        self._photo_http = None
+        self._photo_client_credentials = None
+        self._gmail_service = None
+        self._gmail_service_credentials = None
+        if discovery_cache_dir is None:
+            discovery_cache_dir = os.path.join(os.path.dirname(os.path.abspath(credentials_store)), "discovery_cache")
+        self.discovery_cache = DiscoveryFileCache(discovery_cache_dir)
+        self.resumable_upload = resumable_upload
+        self.upload_chunk_size = upload_chunk_size
+        if upload_session_dir is None:
+            upload_session_dir = os.path.join(os.path.dirname(os.path.abspath(credentials_store)), "upload_sessions")
+        self.upload_session_dir = upload_session_dir
+        self.email_rendition_size = email_rendition_size
+        self.email_rendition_quality = email_rendition_quality
+        if album_cache_file is None:
+            album_cache_file = os.path.join(os.path.dirname(os.path.abspath(credentials_store)), "album_cache.json")
+        self.album_cache_file = album_cache_file
+        self._album_cache_lock = threading.Lock()
         
         if not (self.enable_email or self.enable_upload): # if we don't want features, just return
             return 
@@ -82,12 +412,88 @@ class OAuthServices:
         else:
             return True
     
-    def __oauth_login(self):
+    def start_token_manager(self):
+        """Keep the access token fresh from a background thread
+
+        The token is refreshed ahead of its expiry (with some jitter), so that
+        uploads and emails never wait for the token endpoint. The interactive
+        authorization flow is never started from this thread: without valid
+        stored credentials, the service stays signed out (see setup.py).
+        auth_changed is set whenever signed_in() changes.
+        """
+        if self._token_thread is not None and self._token_thread.is_alive():
+            return
+        self._token_stop.clear()
+        self._token_thread = threading.Thread(target = self.__manage_token, name = "token manager")
+        self._token_thread.daemon = True
+        self._token_thread.start()
+
+    def stop_token_manager(self, timeout = None):
+        """Stop the token manager thread"""
+        self._token_stop.set()
+        if self._token_thread is not None:
+            self._token_thread.join(timeout)
+            self._token_thread = None
+
+    def signed_in(self):
+        """True if the token manager holds a valid access token (never blocks)"""
+        return self._signed_in
+
+    def access_token(self):
+        """The current access token, or None (never blocks)"""
+        return self._access_token
+
+    def __manage_token(self):
+        retry_delay = self.TOKEN_RETRY_DELAY
+        while not self._token_stop.is_set():
+            credentials = None
+            try:
+                credentials = self.__oauth_login(interactive = False, refresh_lead = self.TOKEN_REFRESH_LEAD + self.TOKEN_REFRESH_JITTER)
+            except Exception as e:
+                log.error("token manager: unable to refresh the token (%s)"%str(e))
+            signed_in = credentials is not None and credentials.token_expiry > datetime.utcnow()
+            if signed_in != self._signed_in:
+                log.info("token manager: %s"%("signed in" if signed_in else "signed out"))
+                self._signed_in = signed_in
+                self.auth_changed.set()
+            if signed_in:
+                retry_delay = self.TOKEN_RETRY_DELAY
+                delay = (credentials.token_expiry - datetime.utcnow()).total_seconds() - self.TOKEN_REFRESH_LEAD - random.uniform(0, self.TOKEN_REFRESH_JITTER)
+                delay = max(delay, 1)
+            else:
+                delay = retry_delay
+                retry_delay = min(retry_delay * 2, self.TOKEN_MAX_RETRY_DELAY)
+            log.debug("token manager: next refresh in %ds"%delay)
+            self._token_stop.wait(delay)
+
+    def __oauth_login(self, interactive = True, refresh_lead = None):
+        """Credentials, refreshed if the token expires within refresh_lead seconds
+
+        refresh_lead defaults to 5 minutes, or to 0 if the token manager is
+        running (it refreshes the token ahead of time, an inline refresh is
+        then only done if it didn't succeed).
+        interactive: start the authorization flow if there are no valid credentials
+        (otherwise return None)
+        """
         if not (self.enable_email or self.enable_upload): # if we don't want features, just return
             return None
-        log.debug("__oauth_login: getting cached authentication token")
-        credentials = self.credential_store.get()
+        if refresh_lead is None:
+            refresh_lead = 300
+            if self._token_thread is not None and self._token_thread.is_alive():
+                refresh_lead = 0
+        with self._lock:
+            return self.__locked_oauth_login(interactive, refresh_lead)
+
+    def __locked_oauth_login(self, interactive, refresh_lead):
+        credentials = self._credentials
+        if credentials is None:
+            # only read the credentials store once, then keep credentials in memory
+            log.debug("__oauth_login: getting cached authentication token")
+            credentials = self.credential_store.get()
         if credentials is None or credentials.invalid:
+            if not interactive:
+                log.warning("__oauth_login: No valid credentials found")
+                return None
             log.warning("__oauth_login: No valid credentials found, starting authorization flow")
             try:
                 flow = client.flow_from_clientsecrets(self.client_secret, self.scopes)
@@ -96,19 +502,46 @@ class OAuthServices:
                 log.error("__oauth_login: Error authenticating")
                 raise e
 
-        if (credentials.token_expiry - datetime.utcnow()) < timedelta(minutes=5):
+        if (credentials.token_expiry - datetime.utcnow()) < timedelta(seconds=refresh_lead):
             log.debug("__oauth_login: caching period reached, refreshing token online")
-            credentials.refresh(Http())
+            # refresh() saves the new token in the credentials store attached to credentials
+            credentials.refresh(self.http_pool.view())
 
-        self.credential_store.put(credentials)
+        self._credentials = credentials
+        self._access_token = credentials.access_token
         return credentials
     
-    def __get_photo_client(self):
+    def __get_photo_client(self, interactive = True):
+        """The photoslibrary client, None if there are no valid credentials and interactive is False"""
         if not self.enable_upload: #we don't want it
             return None
-        credentials = self.__oauth_login()
-        return build('photoslibrary', 'v1', http=credentials.authorize(Http()), cache_discovery=False)
+        with self._lock:
+            credentials = self.__oauth_login(interactive)
+            if credentials is None:
+                return None
+            # the client is rebuilt only if the credentials object was replaced (new authorization flow)
+            if self._photo_client is None or self._photo_client_credentials is not credentials:
+                log.debug("__get_photo_client: building photoslibrary client")
+                self._photo_http = credentials.authorize(self.http_pool.view())
+                self._photo_client = build('photoslibrary', 'v1', http=self._photo_http, cache=self.discovery_cache)
+                self._photo_client_credentials = credentials
+            return self._photo_client
         
+    def __get_gmail_service(self, interactive = True):
+        """The gmail service, None if there are no valid credentials and interactive is False"""
+        if not self.enable_email: #we don't want it
+            return None
+        with self._lock:
+            credentials = self.__oauth_login(interactive)
+            if credentials is None:
+                return None
+            # kept for all messages, rebuilt only if the credentials object was replaced
+            if self._gmail_service is None or self._gmail_service_credentials is not credentials:
+                log.debug("__get_gmail_service: building gmail service")
+                self._gmail_service = discovery.build('gmail', 'v1', http=credentials.authorize(self.http_pool.view()), cache=self.discovery_cache)
+                self._gmail_service_credentials = credentials
+            return self._gmail_service
+
     def create_album(self, album_name = "New Album", add_placeholder_picture = False):
         """ Create a new album in user's photo library
             RETURNS: albumId or None if there was an error
@@ -124,6 +557,8 @@ class OAuthServices:
         try:
             res = client.albums().create(body={"album":{"title":album_name}}).execute()
             log.info("create_album: Album %s created with id: %s"%(album_name,res["id"]))
+            for exclude_non_app_created_data in (True, False):
+                self.__write_album_cache("%s:%s"%(self.username, exclude_non_app_created_data), None)
             if add_placeholder_picture:
                 self.upload_picture("placeholder.png", album_id = res["id"], generate_placeholder_picture=True)
             return res["id"]
@@ -132,53 +567,185 @@ class OAuthServices:
             return None
         
 
-    def get_user_albums(self, as_title_id = True, exclude_non_app_created_data = True):
+    def get_user_albums(self, as_title_id = True, exclude_non_app_created_data = True, max_age = None):
         """
         Retrieves connected user list of photo albums as:
             - a list({"title": "the title", "id":"jfqmfjqsjklfaz"}) if as_title_id argument is True (default)
             - the album list
+        (see iter_user_albums for max_age)
         """
         log.debug("get_user_albums: Getting user photos albums")
         if not self.enable_upload:
             log.warning("get_user_albums: Canceled album fetching (enable_upload was set to False)")
             return {}
+        return list(self.iter_user_albums(as_title_id, exclude_non_app_created_data, max_age))
+
+    def iter_user_albums(self, as_title_id = True, exclude_non_app_created_data = True, max_age = None):
+        """Generator yielding the user photo albums as their pages arrive
+
+        The next page is fetched in the background while the caller consumes
+        the current one. A complete listing is saved in the album cache, and
+        served from there while it is younger than max_age. An older listing
+        (up to ALBUM_CACHE_MAX_STALE) is revalidated: only the first page is
+        downloaded, and the cache is kept if the listing still fits in that
+        page and it didn't change. Longer listings are downloaded again (the
+        probed page being the first one). If the probe fails, the older
+        listing is served.
+
+        Arguments:
+            as_title_id (bool)   : yield {"title": "the title", "id": "jfqmfjqsjklfaz"} (albums without
+                                   title are skipped) instead of the album resources
+            exclude_non_app_created_data (bool) : only list the albums created by this application
+            max_age (int)        : maximum age (s) of the cached listing before it is revalidated
+                                   (defaults to ALBUM_CACHE_MAX_AGE, 0 to always download the list)
+        """
+        if not self.enable_upload:
+            log.warning("iter_user_albums: Canceled album fetching (enable_upload was set to False)")
+            return
+        if max_age is None:
+            max_age = self.ALBUM_CACHE_MAX_AGE
+        key = "%s:%s"%(self.username, bool(exclude_non_app_created_data))
+        entry = self.__read_album_cache(key) if max_age > 0 else None
+        pages = None
+        first = None
+        if entry is not None:
+            age = time.time() - entry["fetched_at"]
+            if 0 <= age <= max_age:
+                log.debug("iter_user_albums: %d albums from the cache"%len(entry["albums"]))
+                pages = [entry["albums"]]
+            elif 0 <= age <= self.ALBUM_CACHE_MAX_STALE and entry.get("first_page") is not None:
+                # conditional refresh: albums.list has no ETag, the first page is the validator
+                # (only of a single page listing: the next pages could have changed)
+                try:
+                    first = self.__list_albums(self.__get_photo_client(), exclude_non_app_created_data)
+                except Exception as e:
+                    log.warning("iter_user_albums: unable to revalidate, %d albums from the cache (%s)"%(len(entry["albums"]), str(e)))
+                    pages = [entry["albums"]]
+                if pages is None and not first.get("nextPageToken") and self.__page_fingerprint(first) == entry["first_page"]:
+                    log.debug("iter_user_albums: album list unchanged, %d albums from the cache"%len(entry["albums"]))
+                    self.__write_album_cache(key, entry["albums"], entry["first_page"])
+                    pages = [entry["albums"]]
+        if pages is None:
+            pages = self.__fetch_album_pages(exclude_non_app_created_data, key, first)
+        for page in pages:
+            for album in page:
+                if as_title_id:
+                    #skip albums with no title
+                    if "title" not in album:
+                        continue
+                    yield {"title": album.get("title"), "id": album.get("id")}
+                else:
+                    yield album
+
+    def __list_albums(self, client, exclude_non_app_created_data, token = None):
+        """One albums.list response (the first page if token is None)"""
+        log.debug("iter_user_albums: Fetching %s page of results"%("first" if token is None else "next"))
+        kwargs = {"pageSize": self.ALBUM_PAGE_SIZE, "excludeNonAppCreatedData": exclude_non_app_created_data}
+        if token is not None:
+            kwargs["pageToken"] = token
+        response = client.albums().list(**kwargs).execute()
+        log.debug("iter_user_albums: => %d albums found", len(response.get("albums", [])))
+        return response
+
+    def __page_fingerprint(self, response):
+        """Digest of the albums of an albums.list response (ids and titles) and of whether more pages follow"""
+        albums = [(album.get("id"), album.get("title")) for album in response.get("albums", [])]
+        return hashlib.sha1(json.dumps([albums, bool(response.get("nextPageToken"))])).hexdigest()
+
+    def __fetch_album_pages(self, exclude_non_app_created_data, cache_key, first = None):
+        """Generator yielding the pages of albums.list, the next one being prefetched by a thread
+
+        first: the first response when it was already fetched
+        """
         client = self.__get_photo_client()
+        responses = Queue.Queue(maxsize = 1) # the prefetched page; the fetcher waits while it isn't consumed
+        stop = threading.Event()
+        def put(item):
+            while not stop.is_set():
+                try:
+                    responses.put(item, timeout = 0.5)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        def fetch():
+            response = first
+            try:
+                while True:
+                    if response is None:
+                        response = self.__list_albums(client, exclude_non_app_created_data)
+                    token = response.get("nextPageToken")
+                    # pages can be short (even empty) before the end: only a missing token ends the list
+                    if not put(response) or not token:
+                        break
+                    response = self.__list_albums(client, exclude_non_app_created_data, token)
+                put(None)
+            except Exception as e:
+                log.error("iter_user_albums: Error while processing request: %s"%str(e))
+                put(e)
+        fetcher = threading.Thread(target = fetch, name = "album pages")
+        fetcher.daemon = True
+        fetcher.start()
         albums = []
+        first_page = None
         try:
-            log.debug("get_user_albums: Fetching first page of results")
-            request = client.albums().list(pageSize=50,excludeNonAppCreatedData=exclude_non_app_created_data).execute()
-            log.debug("get_user_albums: => %d albums found",len(request["albums"]))
-            albums.extend(request["albums"])
-            while (request.get("nextPageToken",None) is not None) and (len(request.get("albums",[])) == 50):
-                log.debug("get_user_albums: Fetching next page of results")
-                request = client.albums().list(pageSize=50, pageToken = request["nextPageToken"],excludeNonAppCreatedData=exclude_non_app_created_data).execute()
-                log.debug("get_user_albums: => %d albums found",len(request["albums"]))
-                albums.extend(request["albums"])
-        except KeyError:
-            #no albums
-            log.error("get_users_album: Error while processing request")
-            return albums
-        except Exception as e:
-            import json
-            log.error("get_users_album: Error while processing request: %s"%str(e))
-            raise(e)
-            
-        
-        if as_title_id:
-            #build a list of {"title": "My album Title", "id":"FDQAga124231"} elements
-            album_list = []
-            for album in albums:
-                entry = {}
-                #skip albums with no title
-                if not ("title" in album.keys()):
-                    continue
-                entry['title'] = album.get("title")
-                entry['id']    = album.get("id")
-                album_list.append(entry)
-            return(album_list)
-        else:
-            #full stuff
-            return albums
+            while True:
+                response = responses.get()
+                if response is None:
+                    break
+                if isinstance(response, Exception):
+                    raise response
+                if first_page is None:
+                    first_page = self.__page_fingerprint(response)
+                page = response.get("albums", [])
+                albums.extend(page)
+                yield page
+            self.__write_album_cache(cache_key, albums, first_page)
+            self.__log_http_stats()
+        finally:
+            # the caller may stop before the end of the list
+            stop.set()
+
+    def __album_cache_entries(self):
+        try:
+            with open(self.album_cache_file) as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except (IOError, ValueError):
+            pass
+        return {}
+
+    def __read_album_cache(self, key):
+        """Cache entry of key: {"fetched_at", "albums", "first_page"} or None"""
+        with self._album_cache_lock:
+            entry = self.__album_cache_entries().get(key)
+        if not isinstance(entry, dict) or "fetched_at" not in entry or "albums" not in entry:
+            return None
+        return entry
+
+    def __write_album_cache(self, key, albums, first_page = None):
+        """Save the listing of key (albums = None removes it), first_page is its fingerprint"""
+        with self._album_cache_lock:
+            entries = self.__album_cache_entries()
+            if albums is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = {"fetched_at": time.time(), "albums": albums, "first_page": first_page}
+            try:
+                directory = os.path.dirname(os.path.abspath(self.album_cache_file))
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                # written aside then renamed: a reader never sees a partial file
+                tmp = self.album_cache_file + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(entries, f)
+                os.rename(tmp, self.album_cache_file)
+            except (IOError, OSError) as e:
+                log.warning("iter_user_albums: unable to write the album cache (%s)"%str(e))
+
+    # maximum number of newMediaItems accepted by a single mediaItems.batchCreate call
+    BATCH_CREATE_MAX_ITEMS = 50
 
     def upload_picture(self, filename, album_id = None , title="photo", caption = None, generate_placeholder_picture = False):
         """Upload a picture to Google Photos
@@ -194,85 +761,172 @@ class OAuthServices:
                 This is usefull to create an album and upload a random picture to it so that it shows up in google photos
         """
         log.debug("upload_picture(%s, album_id = %s , title='%s', caption = %s, generate_placeholder_picture = %s)"%(filename,str(album_id),str(title), str(caption), str(generate_placeholder_picture)))
+        return self.upload_pictures([(filename, caption)], album_id, generate_placeholder_picture = generate_placeholder_picture)[0]
+
+    def upload_pictures(self, pictures, album_id = None, generate_placeholder_picture = False):
+        """Upload several pictures to Google Photos with as few mediaItems.batchCreate calls as possible
+
+        Every picture is uploaded on its own (see upload_media), then the upload tokens
+        are referenced by batches of up to BATCH_CREATE_MAX_ITEMS items (see reference_uploads).
+
+        Arguments:
+            pictures (list) : list of (filename, caption) tuples, caption may be None
+            album_id (str)  : id string of the destination album (see upload_picture)
+            generate_placeholder_picture (bool, opt, deflt: False) : see upload_picture
+
+        returns: a list of booleans, True for each picture that was successfully uploaded
+        """
+        results = [False] * len(pictures)
         if not self.enable_upload:
-            log.debug("upload_picture: Canceled (service not configured)")
-            return False
-            
-        client = self.__get_photo_client()
-        creds = self.__oauth_login()
-        
-        # Step I: post file binary and get Token
-        log.debug("upload_picture: Step I: uploading picture %s"%filename)
-        file = os.path.basename(filename)
-        url = 'https://photoslibrary.googleapis.com/v1/uploads'
-        authorization = 'Bearer ' + creds.access_token
+            log.debug("upload_pictures: Canceled (service not configured)")
+            return results
+
+        # Step I: post files binaries and get Tokens
+        items = [] # (index in pictures, (token, caption))
+        for index, (filename, caption) in enumerate(pictures):
+            try:
+                items.append((index, (self.upload_media(filename, generate_placeholder_picture), caption)))
+            except Exception as e:
+                log.error("upload_pictures: Error while uploading picture %s: (%s)"%(filename, str(e)))
+
+        # Step II: reference file Items
+        try:
+            referenced = self.reference_uploads([item for (index, item) in items], album_id)
+        except Exception as e:
+            log.error("upload_pictures: Error while referencing %d picture(s) (%s)"%(len(items), str(e)))
+            return results
+        for (index, item), success in zip(items, referenced):
+            if success:
+                log.info("upload_pictures: successfully uploaded image %s"%pictures[index][0])
+            results[index] = success
+        return results
+
+    def upload_media(self, filename, generate_placeholder_picture = False, interactive = True):
+        """Post the binary of a picture to Google Photos (step I of an upload)
+
+        The picture only shows up in the library once its token is referenced (see reference_uploads).
+        Upload tokens stay valid for a day.
+
+        Arguments:
+            filename (str) : path to the file to upload
+            generate_placeholder_picture (bool, opt, deflt: False) : see upload_picture
+            interactive (bool) : start the authorization flow if there are no valid credentials
+                                 (False from background threads)
+
+        returns: the upload token (raises an exception if the upload failed),
+        None if there are no valid credentials and interactive is False
+        """
+        if not self.enable_upload:
+            raise IOError("upload_media: service not configured")
+        # login, builds the authorized http object
+        if self.__get_photo_client(interactive) is None:
+            log.warning("upload_media: not signed in, %s not uploaded"%filename)
+            return None
+        return self.__upload_media(filename, generate_placeholder_picture)
+
+    def reference_uploads(self, items, album_id = None, interactive = True):
+        """Create media items from upload tokens, BATCH_CREATE_MAX_ITEMS per mediaItems.batchCreate call (step II)
+
+        Arguments:
+            items (list)   : list of (upload token, caption) tuples, caption may be None
+            album_id (str) : id string of the destination album (see upload_picture)
+            interactive (bool) : see upload_media
+
+        returns: a list of booleans, False for each token Google Photos rejected
+        (raises an exception if a batchCreate call failed),
+        None if there are no valid credentials and interactive is False
+        """
+        results = []
+        if len(items) == 0:
+            return results
+        client = self.__get_photo_client(interactive)
+        if client is None:
+            log.warning("reference_uploads: not signed in, %d picture(s) not referenced"%len(items))
+            return None
+        for start in range(0, len(items), self.BATCH_CREATE_MAX_ITEMS):
+            photo_items = []
+            for token, caption in items[start:start + self.BATCH_CREATE_MAX_ITEMS]:
+                if caption is not None:
+                    photo_items.append({"simpleMediaItem": {"uploadToken": token}, "description": caption})
+                else:
+                    photo_items.append({"simpleMediaItem": {"uploadToken": token}})
+            statuses = self.__batch_create(client, photo_items, album_id)
+            for photo_item in photo_items:
+                status = statuses.get(photo_item["simpleMediaItem"]["uploadToken"])
+                success = status is not None and status.get("code", 0) == 0
+                if not success:
+                    log.warning("reference_uploads: upload token was not referenced (%s)"%str(status))
+                results.append(success)
+        self.__log_http_stats()
+        return results
+
+    def __log_http_stats(self):
+        stats = self.http_pool.stats()
+        log.debug("http pool: %(requests)d requests, %(reused)d on a reused connection (%(reuse_rate).0f%%), %(http_objects)d connection objects"%
+                  dict(stats, reuse_rate = stats["reuse_rate"] * 100))
+
+    def __upload_media(self, filename, generate_placeholder_picture = False):
+        """Post a file binary to the uploads endpoint, returns its upload token"""
+        log.debug("__upload_media: uploading picture %s"%filename)
+        url = self.UPLOAD_URL
+        if self.resumable_upload and not generate_placeholder_picture:
+            upload = ResumableUpload(self._photo_http, url, filename, self.upload_session_dir, chunk_size = self.upload_chunk_size)
+            return upload.run()
 
         headers = {
-            "Authorization": authorization,
+            "Authorization": 'Bearer ' + self.access_token(),
             'Content-type': 'application/octet-stream',
-            'X-Goog-Upload-File-Name': file,
+            'X-Goog-Upload-File-Name': os.path.basename(filename),
             'X-Goog-Upload-Protocol': 'raw',
         }
-        http = creds.authorize(Http())
-        
-        try:
-            if generate_placeholder_picture:
-                log.debug("upload_picture: generating placeholder picture")
-                from PIL import Image
-                from random import randint
-                # creating test image
-                color = (randint(0,255),randint(0,255),randint(0,255))
-                im = Image.new("RGB", (32, 32), color=color)
-                import io
-                with io.BytesIO() as output:
-                    im.save(output, format="PNG")
-                    filecontent = output.getvalue()
-            else:
-                with open(filename, "rb") as image_file:
-                    filecontent=image_file.read()
-            log.debug("upload_picture: uploading picture %s (%d bytes)"%(filename,len(filecontent)))
-            (response,token) = http.request(url,method="POST",body=filecontent,headers=headers)
-            if response.status != 200:
-                log.warning("upload_picture: response code for upload %d != 200"%response.status)
-                raise IOError("Error connecting to %s"%url)
-            log.debug("upload_picture: Successfully uploaded image with id:[%s]"%token)
-
-            # Step II: reference file Item
-            if isinstance(caption,str):
-                photo_item = {"simpleMediaItem": {"uploadToken": token}, "description": caption}
-            else:
-                photo_item = {"simpleMediaItem": {"uploadToken": token}}
+        if generate_placeholder_picture:
+            log.debug("__upload_media: generating placeholder picture")
+            from PIL import Image
+            from random import randint
+            # creating test image
+            color = (randint(0,255),randint(0,255),randint(0,255))
+            im = Image.new("RGB", (32, 32), color=color)
+            import io
+            with io.BytesIO() as output:
+                im.save(output, format="PNG")
+                filecontent = output.getvalue()
+        else:
+            with open(filename, "rb") as image_file:
+                filecontent=image_file.read()
+        log.debug("__upload_media: uploading picture %s (%d bytes)"%(filename,len(filecontent)))
+        (response,token) = self._photo_http.request(url,method="POST",body=filecontent,headers=headers)
+        if response.status != 200:
+            log.warning("__upload_media: response code for upload %d != 200"%response.status)
+            raise IOError("Error connecting to %s"%url)
+        log.debug("__upload_media: Successfully uploaded image with id:[%s]"%token)
+        return token
 
-            media_reference = dict(newMediaItems = [photo_item])
-            if album_id is not None:
-                media_reference["albumId"] = album_id
-            
-            import json;log.debug("upload_picture: referencing picture with id: [%s]\n %s"%(token, json.dumps(media_reference,indent=4)))
-            try:
-                try:
-                    res = client.mediaItems().batchCreate(body=media_reference).execute()
-                except HttpError as e:
-                    if "Invalid album ID" in str(e):
-                        log.error("upload_picture: album_id (%s) is not a valid album"%album_id)
-                        log.warning("upload_picture: retrying to reference uploaded image without an album")
-                        #Album is invalid, try to upload to user stream instead
-                        res = client.mediaItems().batchCreate(body=dict(newMediaItems=[{"simpleMediaItem": {"uploadToken": token}}])).execute()
-                if res["newMediaItemResults"][0]["status"]["message"] == "OK":
-                    log.info("upload_picture: successfully uploaded image %s"%filename)
-                    return True
-                else:
-                    log.warning("upload_picture: Unrecognized response")
-                    return False
+    def __batch_create(self, client, photo_items, album_id = None):
+        """Reference uploaded items with a single mediaItems.batchCreate call
 
-            except Exception as e:
-                log.error("upload_picture: Error while referencing picture with id: %s (%s)"%(token,str(e)))
-                return False
-        except Exception as e:
-            log.error("upload_picture: Error while uploading picture: (%s)"%str(e))
-            return False
-        return False
+        If album_id is not a valid album, items are referenced in the user library instead
+
+        returns: a dict {uploadToken: status} built from newMediaItemResults
+        """
+        media_reference = dict(newMediaItems = photo_items)
+        if album_id is not None:
+            media_reference["albumId"] = album_id
+        log.debug("__batch_create: referencing %d picture(s)"%len(photo_items))
+        try:
+            res = client.mediaItems().batchCreate(body=media_reference).execute()
+        except HttpError as e:
+            if album_id is None or not ("Invalid album ID" in str(e)):
+                raise
+            log.error("__batch_create: album_id (%s) is not a valid album"%album_id)
+            log.warning("__batch_create: retrying to reference uploaded images without an album")
+            #Album is invalid, try to upload to user stream instead
+            res = client.mediaItems().batchCreate(body=dict(newMediaItems=photo_items)).execute()
+        statuses = {}
+        for result in res.get("newMediaItemResults", []):
+            statuses[result.get("uploadToken")] = result.get("status", {})
+        return statuses
  
-    def send_message(self,to, subject, body, attachment_file=None):
+    def send_message(self,to, subject, body, attachment_file=None, interactive=True):
         """ send a message using gmail
         
         Arguments:
@@ -280,30 +934,81 @@ class OAuthServices:
             subject (str) : subject line
             body    (str) : body of the message
             attachment_file (str) : path to the file to be attached (or None)
+            interactive (bool) : start the authorization flow if there are no valid credentials
+                                 (False from background threads)
+
+        returns: True if the message was sent, False if Gmail rejected it,
+        None if there are no valid credentials and interactive is False
+        Network errors and temporary Gmail errors (429, 5xx) are raised, the message can be sent again later
         """
         log.debug("send_message(%s, '%s', '...', attachment_file=%s)"%(to, subject,str(attachment_file)))
         if not self.enable_email:
             log.debug("send_message: canceled (enable_email is False)")
             return False
-        credentials = self.__oauth_login()
-        http = credentials.authorize(Http())
-        service = discovery.build('gmail', 'v1', http=http, cache_discovery=False)
+        service = self.__get_gmail_service(interactive)
+        if service is None:
+            log.warning("send_message: not signed in, message to %s not sent"%to)
+            return None
+        if attachment_file is not None:
+            attachment_file = self.__email_rendition(attachment_file)
         
         log.debug("send_message: creating message")
-        message = self.__createMessage(self.username, to, subject, body, body, attachment_file=attachment_file)
-        
+        # the message is written to a file and sent as a media upload (message/rfc822):
+        # no base64url copy of the whole message in memory
+        fd, message_file = tempfile.mkstemp(suffix = ".eml")
         try:
+            with os.fdopen(fd, "w") as output:
+                self.__createMessage(self.username, to, subject, body, body, attachment_file=attachment_file, output=output)
+            media = MediaFileUpload(message_file, mimetype='message/rfc822',
+                                    resumable = os.path.getsize(message_file) > 5 * 1024 * 1024)
             log.debug("sending message")
-            sent_message = (service.users().messages().send(userId="me", body=message).execute())
+            sent_message = (service.users().messages().send(userId="me", body={}, media_body=media).execute())
             log.info('send_message: successfully sent message with id: %s' % sent_message['id'])
+            self.__log_http_stats()
             return True
         except errors.HttpError as error:
+            if error.resp.status == 429 or error.resp.status >= 500:
+                raise
             log.error("send_message: An error occurred during send mail: %s" % error)
             return False
-        return True
+        finally:
+            os.remove(message_file)
+
+    def __email_rendition(self, filename):
+        """Path of the picture to attach to emails: a downscaled JPEG cached next to filename
+
+        The rendition is built on first use and reused while it is newer than the
+        original. The original is returned for non JPEG files (animated GIFs...),
+        pictures already small enough, or if email_rendition_size is None.
+        """
+        if self.email_rendition_size is None or mimetypes.guess_type(filename)[0] != 'image/jpeg':
+            return filename
+        base, ext = os.path.splitext(filename)
+        rendition = base + ".email" + ext
+        try:
+            if os.path.getmtime(rendition) >= os.path.getmtime(filename):
+                return rendition
+        except OSError:
+            pass
+        from PIL import Image
+        try:
+            im = Image.open(filename)
+            size = (self.email_rendition_size, self.email_rendition_size)
+            if max(im.size) <= self.email_rendition_size:
+                return filename
+            im.draft('RGB', size)
+            im.thumbnail(size, Image.ANTIALIAS)
+            # written under a temporary name: a partial file is never taken for a rendition
+            im.save(rendition + ".tmp", format = 'JPEG', quality = self.email_rendition_quality, optimize = True)
+            os.rename(rendition + ".tmp", rendition)
+            log.debug("__email_rendition: %s (%d bytes) -> %s (%d bytes)"%(filename, os.path.getsize(filename), rendition, os.path.getsize(rendition)))
+            return rendition
+        except (IOError, OSError) as e:
+            log.warning("__email_rendition: unable to downscale %s, sending the original (%s)"%(filename, str(e)))
+            return filename
 
     def __createMessage(self,
-        sender, to, subject, msgHtml, msgPlain, attachment_file=None):
+        sender, to, subject, msgHtml, msgPlain, attachment_file=None, output=None):
         """Create a message for an email.
 
         Args:
@@ -313,9 +1018,10 @@ class OAuthServices:
           msgHtml: Html message to be sent
           msgPlain: Alternative plain text message for older email clients          
           attachmentFile (opt): The path to the file to be attached.
+          output (opt): file object the RFC 822 message is written to.
 
         Returns:
-          An object containing a base64url encoded email object.
+          An object containing a base64url encoded email object (None if output is given).
         """
         message = MIMEMultipart('mixed')
         message['to'] = to
@@ -359,6 +1065,9 @@ class OAuthServices:
             msg.add_header('Content-Disposition', 'attachment', filename=filename)
             message.attach(msg)
 
+        if output is not None:
+            Generator(output, mangle_from_=False).flatten(message)
+            return None
         return {'raw': base64.urlsafe_b64encode(message.as_string())}
 
 def test():
@@ -396,5 +1105,89 @@ def test():
     print(gservice.upload_picture("testfile.png",album_id = "BOGUS STRING" , caption="In bogus album", generate_placeholder_picture = True))
     
 
+def test_resumable_upload():
+    """ test resumable uploads against a local stub server (no Google account needed) """
+    logging.basicConfig(level=logging.DEBUG)
+    import random
+    import shutil
+    import tempfile
+    import threading
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    received = []
+    state = {"uploads": 0}
+
+    class StubUploadHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, as googleapis.com
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+            command = self.headers.getheader('X-Goog-Upload-Command')
+            headers = {}
+            content = ""
+            status = 200
+            if command == 'start':
+                headers['X-Goog-Upload-URL'] = "http://127.0.0.1:%d/session"%self.server.server_port
+                headers['X-Goog-Upload-Chunk-Granularity'] = "16"
+            elif command == 'query':
+                headers['X-Goog-Upload-Status'] = 'active'
+                headers['X-Goog-Upload-Size-Received'] = str(len("".join(received)))
+            else:
+                state["uploads"] += 1
+                if state["uploads"] == 3:
+                    status = 503 # simulate a dropped connection
+                else:
+                    received.append(body)
+                    if 'finalize' in command:
+                        content = "stub-upload-token"
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), StubUploadHandler)
+    server_thread = threading.Thread(target = server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    tmp_dir = tempfile.mkdtemp()
+    pool = HttpPool()
+    try:
+        data = "".join([chr(random.randint(0, 255)) for i in range(200)])
+        filename = os.path.join(tmp_dir, "picture.jpg")
+        with open(filename, "wb") as picture:
+            picture.write(data)
+        url = "http://127.0.0.1:%d/uploads"%server.server_port
+        session_dir = os.path.join(tmp_dir, "sessions")
+
+        print "\nUploading until the stub server fails..."
+        try:
+            ResumableUpload(pool.view(), url, filename, session_dir, chunk_size = 50).run()
+            print "FAILED: the stub server should have failed the third chunk"
+            return False
+        except IOError as e:
+            print "\t%s"%str(e)
+        print "\nResuming with a new upload object (as after a restart)..."
+        token = ResumableUpload(pool.view(), url, filename, session_dir, chunk_size = 50).run()
+        success = (token == "stub-upload-token") and ("".join(received) == data) and (len(os.listdir(session_dir)) == 0)
+        print "\ttoken: %s, %d bytes received in %d chunks, success: %s"%(token, len("".join(received)), len(received), str(success))
+        stats = pool.stats()
+        print "\t%d requests, %d on a reused connection (%.0f%%)"%(stats["requests"], stats["reused"], stats["reuse_rate"] * 100)
+        success = success and stats["reused"] > 0
+        return success
+    finally:
+        pool.close() # the stub server serves one connection at a time
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+
 if __name__ == '__main__':
-    test()
+    import sys
+    if "--test-resumable" in sys.argv:
+        test_resumable_upload()
+    else:
+        test()
@@ -0,0 +1,306 @@
+'''
+    Durable on-disk outbox drained by a background worker thread
+
+    Each job is a small json document stored in its own file in the outbox
+    directory, so pending jobs survive a crash or a reboot of the booth.
+    Failed jobs are retried with an exponential backoff. In batch mode, an
+    optional prepare step runs on each job as soon as it is due, and only its
+    result waits for the other jobs of the batch.
+'''
+import os
+import json
+import time
+import random
+import threading
+import logging
+log = logging.getLogger(__name__)
+
+
+class DropJob(Exception):
+    """Raise this from a handler to discard a job that can never succeed
+
+    In batch mode, the handler puts an instance of DropJob in its result list instead
+    """
+    pass
+
+
+class Outbox:
+    """Persistent job queue processed by a worker thread"""
+    JOB_EXTENSION = ".job"
+
+    def __init__(self, directory, handler, name = "outbox", retry_delay = 30, max_retry_delay = 1800, batch_size = 1, batch_window = 0,
+                 prepare = None):
+        """Create the outbox and reload the jobs left by a previous run
+
+        Arguments:
+            directory (str)       : where job files are stored (created if needed)
+            handler               : function handler(job) called from the worker thread,
+                                    returns True when the job is done, False to retry it later,
+                                    None to postpone it without counting a failed attempt
+            name (str)            : name of the worker thread (for logs)
+            retry_delay (s)       : delay before the first retry of a failed job
+            max_retry_delay (s)   : upper bound of the exponential backoff
+            batch_size (int)      : if > 1, handler is called with a list of up to batch_size jobs
+                                    and returns a list with one result per job
+            batch_window (s)      : in batch mode, how long a new (or newly prepared) job may wait
+                                    for others before an incomplete batch is processed
+            prepare               : function prepare(job) called from the worker thread as soon as
+                                    the job is due, before it waits for a batch. It may update the
+                                    job (saved with it) and returns like handler. It is called
+                                    again when the batch handler fails the job.
+        """
+        self.directory = directory
+        self.handler = handler
+        self.name = name
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.prepare = prepare
+        self._jobs = {}          # job_id -> {"job":..., "attempts":..., "next_try":...}
+        self._counter = 0
+        self._stopped = False
+        self._paused = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.__load()
+
+    def __load(self):
+        for entry in sorted(os.listdir(self.directory)):
+            if not entry.endswith(self.JOB_EXTENSION):
+                continue
+            path = os.path.join(self.directory, entry)
+            try:
+                with open(path, 'r') as job_file:
+                    record = json.load(job_file)
+            except Exception as e:
+                log.error("%s: discarding unreadable job %s (%s)"%(self.name, entry, str(e)))
+                os.remove(path)
+                continue
+            # retry reloaded jobs as soon as the worker starts
+            record["next_try"] = 0
+            self._jobs[entry[:-len(self.JOB_EXTENSION)]] = record
+        if len(self._jobs) != 0:
+            log.info("%s: %d pending job(s) reloaded from %s"%(self.name, len(self._jobs), self.directory))
+
+    def __path(self, job_id):
+        return os.path.join(self.directory, job_id + self.JOB_EXTENSION)
+
+    def __write(self, job_id, record):
+        # write then rename so that a crash never leaves a truncated job file
+        path = self.__path(job_id)
+        with open(path + ".tmp", 'w') as job_file:
+            json.dump(record, job_file)
+            job_file.flush()
+            os.fsync(job_file.fileno())
+        os.rename(path + ".tmp", path)
+
+    def __remove(self, job_id):
+        try:
+            os.remove(self.__path(job_id))
+        except OSError:
+            pass
+
+    def start(self):
+        """Start the worker thread"""
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target = self.__run, name = self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout = None):
+        """Stop the worker thread (pending jobs stay on disk)
+
+        In batch mode, the jobs waiting for an incomplete batch are handled first
+        (prepared ones only, see __init__), within timeout
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def pause(self):
+        """Stop processing jobs (e.g. the feature was disabled), they are kept until resume()"""
+        with self._cond:
+            self._paused = True
+
+    def resume(self):
+        """Process the jobs again, starting with the postponed ones"""
+        with self._cond:
+            self._paused = False
+            for record in self._jobs.values():
+                if record["attempts"] == 0:
+                    record["next_try"] = 0
+            self._cond.notify_all()
+
+    def paused(self):
+        with self._cond:
+            return self._paused
+
+    def put(self, job):
+        """Add a job to the outbox
+
+        Arguments:
+            job (dict) : json-serializable description of the job, given to the handler
+
+        returns: the job id
+        """
+        with self._cond:
+            self._counter += 1
+            job_id = "%d-%04d"%(int(time.time() * 1000), self._counter)
+            record = {"job": job, "attempts": 0, "next_try": 0, "queued": time.time(), "prepared": None}
+            self.__write(job_id, record)
+            self._jobs[job_id] = record
+            self._cond.notify_all()
+        log.debug("%s: queued job %s"%(self.name, job_id))
+        return job_id
+
+    def wakeup(self):
+        """Retry all pending jobs now (e.g. when connectivity is back)"""
+        with self._cond:
+            for record in self._jobs.values():
+                record["next_try"] = 0
+            self._cond.notify_all()
+
+    def pending(self):
+        """Number of jobs waiting in the outbox"""
+        with self._cond:
+            return len(self._jobs)
+
+    def failed(self):
+        """Number of pending jobs that already failed at least once"""
+        with self._cond:
+            return len([r for r in self._jobs.values() if r["attempts"] > 0])
+
+    def __next_batch(self):
+        """Returns (step, job_ids, delay): the oldest due jobs or the delay until the batch is ready
+
+        step is "prepare" when the oldest due job still has to be prepared, "handle" otherwise
+        """
+        now = time.time()
+        next_delay = None
+        due = []
+        for job_id in sorted(self._jobs.keys()):
+            delay = self._jobs[job_id]["next_try"] - now
+            if delay <= 0:
+                due.append(job_id)
+            elif next_delay is None or delay < next_delay:
+                next_delay = delay
+        if self.prepare is not None:
+            # preparing doesn't wait for a batch
+            for job_id in due:
+                if self._jobs[job_id].get("prepared") is None:
+                    return "prepare", [job_id], 0
+        if len(due) == 0:
+            return "handle", [], next_delay
+        if len(due) < self.batch_size:
+            # incomplete batch: wait for other jobs until the oldest one has waited long enough
+            oldest = min([self._jobs[job_id].get("prepared") or self._jobs[job_id].get("queued", 0) for job_id in due])
+            delay = oldest + self.batch_window - now
+            if delay > 0:
+                if next_delay is not None and next_delay < delay:
+                    delay = next_delay
+                return "handle", [], delay
+        return "handle", due[:self.batch_size], 0
+
+    def __flush_batch(self):
+        """Due jobs of an incomplete batch (prepared ones only), without waiting for the batch window"""
+        if self.batch_window <= 0:
+            return []
+        now = time.time()
+        due = [job_id for job_id in sorted(self._jobs.keys()) if self._jobs[job_id]["next_try"] <= now
+               and (self.prepare is None or self._jobs[job_id].get("prepared") is not None)]
+        return due[:self.batch_size]
+
+    def __prepare(self, job_id, record):
+        """Call prepare, returns its result (True, False, None or DropJob)"""
+        try:
+            return self.prepare(record["job"])
+        except DropJob as e:
+            return e
+        except Exception:
+            log.exception("%s: error while preparing job %s"%(self.name, job_id))
+            return False
+
+    def __handle(self, job_ids, records):
+        """Call the handler, returns one result (True, False or DropJob) per job"""
+        try:
+            if self.batch_size > 1:
+                results = list(self.handler([record["job"] for record in records]))
+                if len(results) != len(job_ids):
+                    raise ValueError("handler returned %d results for %d jobs"%(len(results), len(job_ids)))
+                return results
+            return [self.handler(records[0]["job"])]
+        except DropJob as e:
+            return [e] * len(job_ids)
+        except Exception:
+            log.exception("%s: error while processing job(s) %s"%(self.name, ", ".join(job_ids)))
+            return [False] * len(job_ids)
+
+    def __run(self):
+        log.debug("%s: worker started"%self.name)
+        while True:
+            with self._cond:
+                if self._stopped:
+                    # flush the incomplete batch instead of leaving it for the next run
+                    step, job_ids = "handle", ([] if self._paused else self.__flush_batch())
+                    if len(job_ids) == 0:
+                        break
+                    records = [self._jobs[job_id] for job_id in job_ids]
+                elif self._paused:
+                    self._cond.wait()
+                    continue
+                else:
+                    step, job_ids, delay = self.__next_batch()
+                    if len(job_ids) == 0:
+                        self._cond.wait(delay)
+                        continue
+                    records = [self._jobs[job_id] for job_id in job_ids]
+
+            if step == "prepare":
+                done = self.__prepare(job_ids[0], records[0])
+                with self._cond:
+                    if done is True:
+                        records[0]["prepared"] = time.time()
+                        self.__write(job_ids[0], records[0])
+                        log.debug("%s: job %s prepared"%(self.name, job_ids[0]))
+                    else:
+                        self.__update(job_ids[0], records[0], done)
+                continue
+
+            results = self.__handle(job_ids, records)
+
+            with self._cond:
+                for job_id, record, done in zip(job_ids, records, results):
+                    if not done and not isinstance(done, DropJob):
+                        record["prepared"] = None # prepare again before the next attempt
+                    self.__update(job_id, record, done)
+        log.debug("%s: worker stopped"%self.name)
+
+    def __update(self, job_id, record, done):
+        """Remove a finished job or schedule its next attempt"""
+        if isinstance(done, DropJob):
+            log.error("%s: dropping job %s (%s)"%(self.name, job_id, str(done)))
+            done = True
+        if done is None:
+            # postponed: not a failure, retried later (or on resume)
+            record["next_try"] = time.time() + self.retry_delay
+            log.debug("%s: job %s postponed"%(self.name, job_id))
+        elif done:
+            del self._jobs[job_id]
+            self.__remove(job_id)
+            log.debug("%s: job %s done"%(self.name, job_id))
+        else:
+            record["attempts"] += 1
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** (record["attempts"] - 1))
+            delay *= random.uniform(0.8, 1.2)
+            record["next_try"] = time.time() + delay
+            self.__write(job_id, record)
+            log.warning("%s: job %s failed (attempt %d), retrying in %ds"%(self.name, job_id, record["attempts"], delay))
@@ -0,0 +1,247 @@
+'''
+    Post-processing stage backed by a process pool
+
+    Compositing, frame overlay and JPEG encoding run in worker processes, so
+    they use the other cores of the Pi and the Tk thread stays free to repaint.
+    Pictures are handed to the workers through shared memory slots (no
+    pickling of multi-megabyte buffers), and every job returns a result
+    object that the UI can poll without blocking.
+'''
+import ctypes
+import multiprocessing
+from PIL import Image
+from AssetCache import ForegroundCache
+import logging
+log = logging.getLogger(__name__)
+
+# State of a worker process: shared slots and cached assets (see _init_worker)
+_worker = {}
+
+
+def _init_worker(slots, foregrounds):
+    _worker["slots"] = slots
+    _worker["foregrounds"] = ForegroundCache()
+    # prepare the frames once per worker, before the first picture
+    for path, size in foregrounds:
+        try:
+            _worker["foregrounds"].get(path, size)
+        except Exception as e:
+            log.error("PostProcessing: unable to prepare %s (%s)"%(path, str(e)))
+
+
+def _read_slot(slot, size, index = 0):
+    """Picture stored in slot (index-th picture of size for a sequence of frames)"""
+    offset = index * size[0] * size[1] * 3
+    return Image.frombuffer('RGB', size, buffer(_worker["slots"][slot], offset), 'raw', 'RGB', 0, 1)
+
+
+def _write_slot(slots, slot, image, index = 0):
+    data = image.tobytes()
+    offset = index * len(data)
+    if offset + len(data) > len(slots[slot]):
+        raise ValueError("image of size %s doesn't fit in a post-processing slot"%repr(image.size))
+    ctypes.memmove(ctypes.addressof(slots[slot]) + offset, data, len(data))
+
+
+def _apply_foreground(canvas, foreground, box, offset = (0, 0)):
+    """Paste the box region of the foreground (path, size) onto canvas at offset"""
+    path, size = foreground
+    front, mask = _worker["foregrounds"].get(path, size)
+    canvas.paste(front.crop(box), offset, mask.crop(box))
+
+
+def _composite_tile(slot, box, foreground):
+    """Worker job: apply the foreground region of box on the tile stored in slot"""
+    if foreground is None:
+        return slot
+    tile_size = (box[2] - box[0], box[3] - box[1])
+    tile = _read_slot(slot, tile_size)
+    _apply_foreground(tile, foreground, box)
+    _write_slot(_worker["slots"], slot, tile)
+    return slot
+
+
+def _encode(filename, size, tiles, foreground, covered):
+    """Worker job: assemble the tiles stored in slots and save the picture as JPEG"""
+    canvas = Image.new('RGB', size)
+    for slot, box in tiles:
+        canvas.paste(_read_slot(slot, (box[2] - box[0], box[3] - box[1])), box[:2])
+    if foreground is not None:
+        boxes = [(0, 0) + tuple(size)]
+        if covered:
+            # tiles already have their part of the foreground, only fill the other regions
+            boxes = _uncovered_boxes(size, [box for slot, box in tiles])
+        for box in boxes:
+            _apply_foreground(canvas, foreground, box, box[:2])
+    canvas.save(filename)
+    return filename
+
+
+def _encode_animation(filename, size, slot, count, duration, boomerang, colors):
+    """Worker job: save the frames stored in slot as an optimized, looping GIF"""
+    frames = [_read_slot(slot, size, i) for i in range(count)]
+    if boomerang:
+        # play forward then backward, without repeating the end frames
+        frames = frames + frames[-2:0:-1]
+    # a single palette for the whole animation: frames only differ where the
+    # picture changed, so the GIF writer can store each one as a small delta
+    palette = frames[count // 2].quantize(colors)
+    frames = [frame.quantize(palette = palette) for frame in frames]
+    frames[0].save(filename, format = 'GIF', save_all = True, append_images = frames[1:],
+                   duration = duration, loop = 0, optimize = True)
+    return filename
+
+
+def _uncovered_boxes(size, boxes):
+    """Grid cells of the tiles size that are not in boxes"""
+    if len(boxes) == 0:
+        return [(0, 0) + tuple(size)]
+    w, h = boxes[0][2] - boxes[0][0], boxes[0][3] - boxes[0][1]
+    cells = []
+    for y in range(0, size[1], h):
+        for x in range(0, size[0], w):
+            if (x, y, x + w, y + h) not in boxes:
+                cells.append((x, y, x + w, y + h))
+    return cells
+
+
+class PostProcessResult:
+    """Pending result of an encoding job, possibly waiting for other jobs first"""
+    def __init__(self, pool, args, wait_for = []):
+        self._pool = pool
+        self._args = args
+        self._wait_for = list(wait_for)
+        self._result = None
+
+    def ready(self):
+        """True when the job is done or one of the jobs it depends on failed (never blocks nor raises)
+
+        get() then returns the result or raises the error
+        """
+        if self._result is None:
+            if not all([result.ready() for result in self._wait_for]):
+                return False
+            if not all([result.successful() for result in self._wait_for]):
+                return True
+            self._result = self._pool.apply_async(_encode, self._args)
+        return self._result.ready()
+
+    def get(self, timeout = None):
+        """Wait for the job and return its result (raises the job exception if it failed)"""
+        for result in self._wait_for:
+            result.get(timeout)
+        if self._result is None:
+            self._result = self._pool.apply_async(_encode, self._args)
+        return self._result.get(timeout)
+
+
+class PostProcessor:
+    """Process pool owning compositing, frame overlay and encoding of pictures"""
+    def __init__(self, slot_size, slots = 3, processes = None, foregrounds = []):
+        """Allocate the shared slots and start the worker processes
+
+        Arguments:
+            slot_size (int)    : size in bytes of a slot, must hold the largest RGB picture
+            slots (int)        : number of pictures that can be processed at the same time
+            processes (int)    : number of worker processes (defaults to the number of cores)
+            foregrounds (list) : (path, size) of the frames the workers should prepare at start
+        """
+        self.slots = [multiprocessing.RawArray(ctypes.c_char, slot_size) for i in range(slots)]
+        self.pool = multiprocessing.Pool(processes, _init_worker, (self.slots, foregrounds))
+
+    def store(self, slot, image):
+        """Copy a RGB picture into a shared slot"""
+        _write_slot(self.slots, slot, image.convert('RGB'))
+
+    def composite_tile(self, slot, tile, box, foreground = None):
+        """Store a tile and apply the matching region of the foreground in a worker
+
+        Arguments:
+            slot (int)          : slot where the tile is stored
+            tile (PIL Image)    : the tile
+            box (tupple)        : (left, upper, right, lower) position of the tile in the picture
+            foreground (tupple) : (path, picture size) of the frame, or None
+
+        returns: an AsyncResult
+        """
+        self.store(slot, tile)
+        return self.pool.apply_async(_composite_tile, (slot, box, foreground))
+
+    def store_frames(self, slot, frames):
+        """Copy a sequence of RGB frames of the same size into a shared slot"""
+        for index, frame in enumerate(frames):
+            _write_slot(self.slots, slot, frame.convert('RGB'), index)
+
+    def encode_animation(self, filename, slot, size, count, duration, boomerang = False, colors = 128):
+        """Save frames stored with store_frames as an animated GIF in a worker
+
+        Arguments:
+            filename (str)    : output GIF file
+            slot (int)        : slot holding the frames
+            size tupple(w,h)  : size of the frames
+            count (int)       : number of frames
+            duration (int)    : display time of each frame (ms)
+            boomerang (bool)  : play the frames forward then backward
+            colors (int)      : size of the palette (<= 256)
+
+        returns: an AsyncResult, its result is filename
+        """
+        return self.pool.apply_async(_encode_animation, (filename, size, slot, count, duration, boomerang, colors))
+
+    def encode(self, filename, size, tiles, foreground = None, wait_for = []):
+        """Assemble stored pictures and save them as JPEG in a worker
+
+        Arguments:
+            filename (str)      : output JPEG file
+            size tupple(w,h)    : size of the picture
+            tiles (list)        : (slot, box) of the stored pictures to assemble
+            foreground (tupple) : (path, size) of the frame to paste over the picture, or None
+            wait_for (list)     : results of composite_tile, the foreground is then only
+                                  applied to the regions without tiles
+
+        returns: a PostProcessResult, its result is filename
+        """
+        return PostProcessResult(self.pool, (filename, size, tiles, foreground, len(wait_for) != 0), wait_for)
+
+    def close(self):
+        """Stop the worker processes"""
+        self.pool.terminate()
+
+
+if __name__ == '__main__':
+    # Benchmark: collage composited and encoded in the calling process vs in the pool
+    import os
+    import time
+    import random
+    import tempfile
+    from Collage import CollageBuilder
+    from constants import MODE_PARAMETERS
+
+    w, h = MODE_PARAMETERS['collage']['snap_size']
+    path = MODE_PARAMETERS['collage']['foreground_image']
+    positions = [(0, 0), (w, 0), (0, h)]
+    tiles = [Image.new('RGB', (w, h), tuple([random.randint(0, 255) for c in range(3)])) for i in positions]
+    filename = os.path.join(tempfile.mkdtemp(), "collage.jpg")
+
+    front, mask = ForegroundCache().get(path, (w * 2, h * 2))
+    start = time.time()
+    canvas = Image.new('RGB', (w * 2, h * 2))
+    for tile, position in zip(tiles, positions):
+        canvas.paste(tile, position)
+    canvas.paste(front, (0, 0), mask)
+    canvas.save(filename)
+    local = time.time() - start
+
+    processor = PostProcessor(w * h * 12, foregrounds = [(path, (w * 2, h * 2))])
+    time.sleep(1) # let the workers prepare the frame
+    collage = CollageBuilder(processor, (w, h), positions, path)
+    for tile in tiles:
+        collage.add(tile)
+        time.sleep(0.5) # the countdown of the next tile
+    start = time.time()
+    collage.finish(filename).get()
+    pooled = time.time() - start
+    processor.close()
+    os.remove(filename)
+    print "collage after the last shot, in process: %.1fms" % (local * 1000)
+    print "collage after the last shot, pipelined:  %.1fms" % (pooled * 1000)
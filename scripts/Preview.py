@@ -0,0 +1,139 @@
+'''
+    Software live preview for cameras without a GPU preview
+
+    picamera draws its preview directly on the screen; Camera.Camera (cv2) and
+    fakehardware don't, so the guests would stare at a black screen during the
+    countdown. SoftwarePreview captures frames in a background thread, scales
+    them down to the window size and shows them in a Tk label at a target frame
+    rate, with the countdown overlay composited on top. Frames that arrive
+    faster than they are displayed are dropped, so the preview never lags.
+'''
+import io
+import time
+import threading
+from PIL import Image, ImageTk
+from Capture import capture_image
+import logging
+log = logging.getLogger(__name__)
+
+
+class SoftwarePreview:
+    """Live camera preview rendered in a Tk label"""
+    def __init__(self, label, camera, size, fps = 15):
+        """Create the preview (call start() to show it)
+
+        Arguments:
+            label (Tk Label)  : widget the preview is rendered in
+            camera            : a Camera.Camera or fakehardware.PiCamera object
+            size tupple(w,h)  : size of the preview area
+            fps (float)       : target frame rate
+        """
+        self.label = label
+        self.camera = camera
+        self.size = tuple(size)
+        self.period = 1.0 / fps
+        self.hflip = True       # mirror effect for easier selfies
+        self.fps = 0.0          # achieved frame rate of the last second
+        self.dropped = 0        # frames captured but never displayed
+        self._photo = None      # reused between frames (same size)
+        self._photo_size = None
+        self._overlay = None
+        self._latest = None     # newest scaled frame, waiting for display
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._after_id = None
+        self._shown = 0
+        self._fps_start = 0
+
+    def start(self):
+        """Start capturing and displaying frames"""
+        if self._running:
+            return
+        self._running = True
+        self._latest = None
+        self._shown = 0
+        self._fps_start = time.time()
+        self._thread = threading.Thread(target = self.__capture_loop, name = "preview")
+        self._thread.daemon = True
+        self._thread.start()
+        self._next_tick = time.time()
+        self.__tick()
+
+    def stop(self):
+        """Stop the preview and clear the label"""
+        if not self._running:
+            return
+        self._running = False
+        if self._after_id is not None:
+            self.label.after_cancel(self._after_id)
+            self._after_id = None
+        self._thread.join(1)
+        self.label.config(image = "")
+        log.debug("SoftwarePreview: stopped (%.1ffps, %d frames dropped)"%(self.fps, self.dropped))
+
+    def running(self):
+        return self._running
+
+    def set_overlay(self, overlay):
+        """Composite overlay (PIL RGBA Image of the preview size, or None) on top of the frames"""
+        self._overlay = overlay
+
+    def __capture_loop(self):
+        stream = io.BytesIO()
+        while self._running:
+            start = time.time()
+            try:
+                frame = capture_image(self.camera, stream)
+            except Exception as e:
+                log.warning("SoftwarePreview: capture failed (%s)"%repr(e))
+                time.sleep(self.period)
+                continue
+            # fit to the preview area: nearest neighbour is plenty for a preview
+            ratio = max(float(frame.size[0]) / self.size[0], float(frame.size[1]) / self.size[1])
+            frame = frame.resize((int(frame.size[0] / ratio), int(frame.size[1] / ratio)), Image.NEAREST)
+            if self.hflip:
+                frame = frame.transpose(Image.FLIP_LEFT_RIGHT)
+            with self._lock:
+                if self._latest is not None:
+                    self.dropped += 1
+                self._latest = frame
+            # no need to capture faster than the display
+            delay = start + self.period - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def __tick(self):
+        if not self._running:
+            return
+        with self._lock:
+            frame = self._latest
+            self._latest = None
+        if frame is not None:
+            self.__show(frame)
+        # deadline based: a slow frame doesn't shift the next ones
+        self._next_tick += self.period
+        now = time.time()
+        if self._next_tick < now:
+            self._next_tick = now
+        self._after_id = self.label.after(int((self._next_tick - now) * 1000), self.__tick)
+
+    def __show(self, frame):
+        overlay = self._overlay
+        if overlay is not None:
+            # the label centers the frame: use the matching region of the overlay
+            x = (self.size[0] - frame.size[0]) // 2
+            y = (self.size[1] - frame.size[1]) // 2
+            region = overlay.crop((x, y, x + frame.size[0], y + frame.size[1]))
+            frame.paste(region, (0, 0), region)
+        if self._photo is None or self._photo_size != frame.size:
+            self._photo = ImageTk.PhotoImage('RGB', frame.size)
+            self._photo_size = frame.size
+            self.label.config(image = self._photo)
+        self._photo.paste(frame)
+        self._shown += 1
+        now = time.time()
+        if now - self._fps_start >= 1.0:
+            self.fps = self._shown / (now - self._fps_start)
+            self._shown = 0
+            self._fps_start = now
@@ -4,7 +4,16 @@ import time
 import traceback
 import os
 import subprocess
+import io
 import OAuthServices
+import Outbox
+from Countdown import Countdown
+from AudioPlayer import AudioPlayer
+from AssetCache import CountdownOverlayCache
+from Capture import capture_image, capture_frames, best_frame
+from Preview import SoftwarePreview
+from Collage import CollageBuilder
+from PostProcessing import PostProcessor
 from Tkinter import *
 from PIL import Image, ImageTk
 from mykb import TouchKeyboard
@@ -52,6 +61,24 @@ except ImportError:
         #SystemExit('No camera installed!')
 
 
+def create_postprocessor():
+    """Start the post-processing pool, sized for the pictures of every mode
+
+    Call this before the UserInterface is created: the worker processes are
+    forked from the calling process, which must not own a Tk window or
+    threads yet (the workers would inherit a copy of them and of their locks)
+
+    returns: a PostProcessing.PostProcessor (see UserInterface)
+    """
+    # slots hold what is stored from the UI: a shot, a collage tile or the frames
+    # of an animation (RGB); collages are assembled in the workers, never in a slot
+    slot_size = max([p['snap_size'][0] * p['snap_size'][1] * p.get('frames', 1) for p in MODE_PARAMETERS.values()]) * 3
+    # the workers prepare the collage frame once at startup
+    collage_size = MODE_PARAMETERS['collage']['snap_size']
+    collage_size = (collage_size[0] * 2, collage_size[1] * 2)
+    return PostProcessor(slot_size, foregrounds = [(MODE_PARAMETERS['collage']['foreground_image'], collage_size)])
+
+
 class UserInterface():
     
     """
@@ -62,33 +89,45 @@ class UserInterface():
         window_size  tupple(w,h) : the window size (defaults to size in constants.py)
         poll_period : polling period for hardware buttons changes (ms)
         log_level : amount of log (see python module 'logging')
+        postprocessor : the post-processing pool, see create_postprocessor()
+                        (created here if None, before any window or thread)
     """
-    def __init__(self, config, window_size = None, poll_period = HARDWARE_POLL_PERIOD, log_level = logging.INFO):
+    def __init__(self, config, window_size = None, poll_period = HARDWARE_POLL_PERIOD, log_level = logging.INFO, postprocessor = None):
 
         import datetime
 
+        # Compositing and encoding run in a pool of worker processes
+        if postprocessor is None:
+            postprocessor = create_postprocessor()
+        self.postprocessor = postprocessor
+
         """
         Events to enable/disable cursor based on motion
-        on_motion() is called on mouse motion and sets a boolean
-        enable_cursor is a fast loop that checks this boolean and enable the cursor
-        check_and_disable_cursor is a slow loop that checks this boolean and resets it
+        on_motion() is called on mouse motion: it shows the cursor if it was hidden
+        and arms the idle timer if it isn't already
+        check_and_disable_cursor is the idle timer: it hides the cursor once there was
+        no motion for CURSOR_HIDE_DELAY, or re-arms itself for the remaining time.
+        Nothing runs while the cursor is hidden and the mouse doesn't move.
         """
-        def enable_cursor():
-            if self.cursor_motion:
-                self.root.config(cursor = "")
-            self.enable_cursor_after_id = self.root.after(200, enable_cursor)
-
         def check_and_disable_cursor():
-            if self.cursor_motion == False:
+            self.cursor_wakeups += 1
+            self.disable_cursor_after_id = None
+            idle = int((time.time() - self.last_motion_time) * 1000)
+            if idle >= CURSOR_HIDE_DELAY:
                 #remove the cursor,reactivated by motion
+                self.cursor_visible = False
                 self.root.config(cursor = "none")
+                self.log.debug("cursor hidden (%d idle timer wakeups so far)"%self.cursor_wakeups)
             else:
-                #erase it
-                self.cursor_motion = False
-            self.disable_cursor_after_id = self.root.after(3000, check_and_disable_cursor)
+                self.disable_cursor_after_id = self.root.after(CURSOR_HIDE_DELAY - idle, check_and_disable_cursor)
         
         def on_motion(event):
-            self.cursor_motion = True
+            self.last_motion_time = time.time()
+            if not self.cursor_visible:
+                self.cursor_visible = True
+                self.root.config(cursor = "")
+            if self.disable_cursor_after_id is None:
+                self.disable_cursor_after_id = self.root.after(CURSOR_HIDE_DELAY, check_and_disable_cursor)
 
         def quit():
             self.log.debug('exiting')
@@ -205,7 +244,9 @@ class UserInterface():
         self.root                    = Tk()
         self.log                     = logging.getLogger("UserInterface")
         self.log_level               = log_level
-        self.cursor_motion           = False
+        self.cursor_visible          = True
+        self.last_motion_time        = time.time()
+        self.cursor_wakeups          = 0 # number of runs of the cursor idle timer
         self.full_screen             = config.full_screen
         self.selected_image_effect   = 'none'
         self.send_prints             = config.enable_print
@@ -213,8 +254,7 @@ class UserInterface():
         self.image_effects           = config.enable_effects
         self.hardware_buttons        = config.enable_hardware_buttons
         self.quit                    = quit        
-        self.enable_cursor_after_id  = self.root.after(100, enable_cursor)
-        self.disable_cursor_after_id = self.root.after(2000, check_and_disable_cursor)
+        self.disable_cursor_after_id = self.root.after(CURSOR_HIDE_DELAY, check_and_disable_cursor)
         
         self.log.setLevel(self.log_level)
         self.root.bind("<Motion>", on_motion)
@@ -222,10 +262,12 @@ class UserInterface():
 
         self.install_key_binding("snap_single", safe_execute_factory(lambda *args: self.snap("single")))
         self.install_key_binding("snap_collage", safe_execute_factory(lambda *args: self.snap("collage")))
+        self.install_key_binding("snap_animation", safe_execute_factory(lambda *args: self.snap("animation")))
         self.install_key_binding("send_email", safe_execute_factory(lambda *args: self.send_email()))
         self.install_key_binding("send_print", safe_execute_factory(lambda *args: self.send_print()))
         self.install_key_binding("configure", safe_execute_factory(lambda *args: self.long_press_cb(self)))
         self.install_key_binding("quit", safe_execute_factory(lambda *args: self.quit()))
+        self.install_key_binding("cancel_snap", lambda *args: self.cancel_countdown())
      
         ## Bind keyboard keys to actions
         if self.full_screen:
@@ -283,9 +325,13 @@ class UserInterface():
         self.status_lbl.config(background = BG_COLOR, foreground=FG_COLOR)
         self.status_lbl.place(x=0 + 10, y=0)
 
+        #Create pending uploads counter (top-right corner)
+        self.upload_status_lbl = Label(self.root, text="", font=("Helvetica", 10))
+        self.upload_status_lbl.config(background = BG_COLOR, foreground=FG_COLOR)
+        self.upload_status_lbl.place(relx=1.0, x=-10, y=0, anchor=NE)
+
         #State variables
         self.signed_in = False
-        self.auth_after_id = None
         self.poll_period = poll_period
         self.poll_after_id = None
 
@@ -298,6 +344,7 @@ class UserInterface():
         self.email_addr = StringVar()
 
         self.suspend_poll = False
+        self.countdown    = None # the running Countdown, if any
 
         self.config           = config
         self.upload_images    = config.enable_upload
@@ -313,11 +360,33 @@ class UserInterface():
             self.account_email,
             enable_email = self.send_emails,
             enable_upload = self.upload_images,
-            log_level = self.log_level)
+            log_level = self.log_level,
+            email_rendition_size = EMAIL_RENDITION_SIZE,
+            email_rendition_quality = EMAIL_RENDITION_QUALITY)
+
+        # Uploads are handed off to a background worker, pending ones are kept on disk
+        self.upload_outbox = Outbox.Outbox(
+            os.path.join(self.configdir, UPLOAD_OUTBOX_DIR),
+            self.__upload_jobs,
+            name = "upload",
+            retry_delay = UPLOAD_RETRY_DELAY,
+            max_retry_delay = UPLOAD_MAX_RETRY_DELAY,
+            batch_size = UPLOAD_BATCH_SIZE,
+            batch_window = UPLOAD_BATCH_WINDOW,
+            prepare = self.__upload_media_job)
+
+        # Emails are sent by a background worker too, so that the keyboard closes at once
+        self.email_outbox = Outbox.Outbox(
+            os.path.join(self.configdir, EMAIL_OUTBOX_DIR),
+            self.__send_email_job,
+            name = "email",
+            retry_delay = EMAIL_RETRY_DELAY,
+            max_retry_delay = EMAIL_MAX_RETRY_DELAY)
 
         # Hardware buttons - these would be used to start various picture modes
         if self.hardware_buttons:
-            self.buttons = HWB.HardwareButtons( buttons_pins = HARDWARE_BUTTONS['button_pins'], mode = HARDWARE_BUTTONS["pull_up_down"], active_state = HARDWARE_BUTTONS["active_state"])
+            self.buttons = HWB.HardwareButtons( buttons_pins = HARDWARE_BUTTONS['button_pins'], mode = HARDWARE_BUTTONS["pull_up_down"], active_state = HARDWARE_BUTTONS["active_state"],
+                event_driven = HARDWARE_BUTTONS.get("event_driven", False), debounce = HARDWARE_BUTTONS.get("debounce", 200))
         else:
             self.buttons = HWB.HardwareButtons( buttons_pins = [], mode="pull_down", active_state=0)
 
@@ -330,15 +399,35 @@ class UserInterface():
         self.camera.annotate_text_size = 160 # Maximum size
         self.camera.annotate_foreground = Color(FG_COLOR)
         self.camera.annotate_background = Color(BG_COLOR)
-        
+        # picamera draws its own preview, other backends are previewed in the main label
+        self.preview = None
+        if mycamera.__name__ != "picamera":
+            self.preview = SoftwarePreview(self.image, self.camera, self.size, fps = SOFTWARE_PREVIEW_FPS)
+
+        # Sounds are decoded once and played by a persistent player
+        self.audio = AudioPlayer(MP3S)
+        self.audio.preload()
+        self.beep_to_shutter = None # delay between the last countdown beep reaching the speaker and the shutter (s)
+        self.capture_stream = io.BytesIO() # reused by in-memory captures
+
+        # Countdown overlays are built once for the screen size
+        self.countdown_overlays = CountdownOverlayCache(COUNTDOWN_OVERLAY_IMAGES, COUNTDOWN_IMAGE_MAX_HEIGHT_RATIO)
+        self.countdown_overlays.build(self.__preview_size())
+
         self.long_press_cb = long_press_cb
         self.longpress_obj = LongPressDetector(self.root, long_press_cb)
 
     """ Destructor """
     def __del__(self):
         try:
-            self.root.after_cancel(self.auth_after_id)
+            self.oauth2service.stop_token_manager(timeout = 1)
             self.root.after_cancel(self.poll_after_id)
+            if self.buttons.events_enabled():
+                self.root.tk.deletefilehandler(self.buttons.fileno())
+            self.upload_outbox.stop(timeout = 10) # references the uploads waiting for a batch
+            self.email_outbox.stop(timeout = 1)
+            self.audio.close()
+            self.postprocessor.close()
             self.camera.close()
         except:
             pass
@@ -357,13 +446,56 @@ class UserInterface():
         self.status_lbl['text'] = status_text
         self.root.update()
 
+    """ Update the pending/failed uploads and emails counter """
+    def update_upload_status(self):
+        pending = self.upload_outbox.pending()
+        failed = self.upload_outbox.failed()
+        texts = []
+        if pending != 0:
+            text = "%d pending upload(s)"%pending
+            if failed != 0:
+                text += ", %d failed"%failed
+            texts.append(text)
+        if self.email_outbox.pending() != 0:
+            texts.append("%d pending email(s)"%self.email_outbox.pending())
+        text = " - ".join(texts)
+        # only reconfigure the label when the text actually changes
+        if self.upload_status_lbl['text'] != text:
+            self.upload_status_lbl['text'] = text
+
     """ Start the user interface and call Tk::mainloop() """
     def start_ui(self):
-        self.auth_after_id = self.root.after(100, self.refresh_auth)
+        self.refresh_auth()
+        if self.buttons.events_enabled():
+            # presses wake the Tk loop up through the buttons pipe, no need to poll them
+            self.log.info("Hardware buttons are event driven")
+            self.root.tk.createfilehandler(self.buttons.fileno(), READABLE, self.__on_button_events)
+            self.poll_period = HOUSEKEEPING_PERIOD
         self.poll_after_id = self.root.after(self.poll_period, self.run_periodically)
+        # the workers of disabled features keep their jobs on disk without trying them
+        if not self.upload_images:
+            self.upload_outbox.pause()
+        if not self.send_emails:
+            self.email_outbox.pause()
+        self.upload_outbox.start()
+        self.email_outbox.start()
         self.root.mainloop()
 
-    """ Hardware poll function launched by start_ui """
+    """ Handle the presses queued by event driven hardware buttons """
+    def __on_button_events(self, fileno, mask):
+        for button, timestamp in self.buttons.get_events():
+            self.log.debug("button %d pressed %.1fms ago"%(button, (time.time() - timestamp) * 1000))
+            if self.suspend_poll == True:
+                # pressed during a snap or while the keyboard is up: ignored, as when polling
+                continue
+            if button == 1:
+                self.snap("single")
+            elif button == 2:
+                self.snap("collage")
+            elif button == 3:
+                self.snap("animation")
+
+    """ Hardware poll function launched by start_ui (only housekeeping when buttons are event driven) """
     def run_periodically(self):
         import datetime
 
@@ -374,13 +506,17 @@ class UserInterface():
                 self.print_btn.place_forget();
 
         # self.log.debug(self.image)
+        self.update_upload_status()
+        self.check_auth()
 
-        if not self.suspend_poll == True:
+        if not self.suspend_poll == True and not self.buttons.events_enabled():
             btn_state = self.buttons.state()
             if btn_state == 1:
                 self.snap("single")
             elif btn_state == 2:
                 self.snap("collage")
+            elif btn_state == 3:
+                self.snap("animation")
 
         self.poll_after_id = self.root.after(self.poll_period, self.run_periodically)
 
@@ -394,44 +530,28 @@ class UserInterface():
         h = snap_size[1]
         w_ = w * 2
         h_ = h * 2
-        # take 4 photos and merge into one image.
+        #get the collage frame if it exists
+        foreground = MODE_PARAMETERS['collage']['foreground_image']
+        if not os.path.isfile(foreground):
+            self.log.error("snap: unable to paste collage cover: %s doesn't exist"%foreground)
+            foreground = None
+
+        # take 3 photos and merge them into one image while the next countdown runs
+        collage = CollageBuilder(self.postprocessor, (w, h), [(0, 0), (w, 0), (0, h)], foreground)
         for i in range(1, 4):
-            self.__show_countdown(TIMER, font_size = 80)
-            self.camera.capture('collage_' + str(i) + '.jpg')
-            try:
-                os.system("mpg321 " + MP3S['shutter'])
-            except Exception, e:
-                self.log.debug(e);
-                pass
-
-        # Assemble collage
-        self.camera.stop_preview()
-        self.set_status("Assembling collage")
-        self.log.debug("snap: assembling collage")
-        snapshot = Image.new('RGBA', (w_, h_))
-        snapshot.paste(Image.open('collage_1.jpg'), (0, 0, w, h))
-        snapshot.paste(Image.open('collage_2.jpg'), (w, 0, w_, h))
-        snapshot.paste(Image.open('collage_3.jpg'), (0, h, w, h_))
-        # snapshot.paste(Image.open('collage_4.jpg'), (w, h, w_, h_))
+            if not self.__show_countdown(TIMER, font_size = 80):
+                collage.cancel()
+                return None, picture_taken
+            collage.add(self.__shutter())
         picture_taken = True
-        
-        #paste the collage frame if it exists
-        try:
-            self.log.debug("snap: Adding the collage cover")
-            front = Image.open(MODE_PARAMETERS['collage']['foreground_image'])
-            front = front.resize((w_,h_))
-            front = front.convert('RGBA')
-            snapshot = snapshot.convert('RGBA')
-            snapshot = Image.alpha_composite(snapshot, front)
-
-        except Exception, e:
-            self.log.error("snap: unable to paste collage cover: %s"%repr(e))
 
-        self.set_status("")
+        # Finish collage (last tile and encoding)
+        self.__stop_preview()
+        self.set_status("Assembling collage")
         self.log.debug("snap: Saving collage")
         filename = timestamp + '.jpg'
-        snapshot = snapshot.convert('RGB')
-        snapshot.save(filename)
+        self.__wait_for(collage.finish(filename))
+        self.set_status("")
         
         return filename, picture_taken
 
@@ -439,23 +559,43 @@ class UserInterface():
     def single_snap(self):
 
         self.log.debug("snap: single picture")
-        self.__show_countdown(TIMER, font_size = 80)
+        if not self.__show_countdown(TIMER, font_size = 80):
+            return None, False
         picture_taken = True        
         filename = self.last_picture_filename;
-        # simple shot with logo
-        self.camera.capture(filename)
-        snapshot = Image.open(filename)
-        snapshot.save(filename)
-        self.camera.stop_preview()
-
-        try:
-            os.system("mpg321 " + MP3S['shutter'])
-        except Exception, e:
-            self.log.debug(e);
-            pass
+        # simple shot with logo, encoded once by the post-processing pool
+        burst = MODE_PARAMETERS['single'].get('burst', 1)
+        if burst > 1:
+            snapshot = self.__burst(burst)
+        else:
+            snapshot = self.__shutter()
+        self.__stop_preview()
+        self.postprocessor.store(0, snapshot)
+        self.__wait_for(self.postprocessor.encode(filename, snapshot.size, [(0, (0, 0) + snapshot.size)]))
 
         return filename, picture_taken
 
+    """ Capture a short burst and save it as an animated GIF """
+    def animation_snap(self, snap_size):
+        params = MODE_PARAMETERS['animation']
+        self.log.debug("snap: animation of %d frames"%params['frames'])
+        if not self.__show_countdown(TIMER, font_size = 80):
+            return None, False
+        self.__play_sound("shutter")
+        frames, fps = capture_frames(self.camera, params['frames'], params['fps'], self.capture_stream)
+        self.__stop_preview()
+        if fps < params['fps'] * 0.9:
+            self.log.warning("snap: animation captured at %.1ffps (target %dfps)"%(fps, params['fps']))
+        # frames go to a shared slot, the GIF is encoded by the post-processing pool
+        self.set_status("Assembling animation")
+        self.postprocessor.store_frames(0, frames)
+        del frames
+        filename = self.last_picture_filename
+        self.__wait_for(self.postprocessor.encode_animation(filename, 0, snap_size, params['frames'],
+            int(1000 / params['fps']), params['boomerang'], params['colors']))
+        self.set_status("")
+        return filename, True
+
     """ Snap a shot in given mode
 
         This will start a countdown preview and:
@@ -465,7 +605,7 @@ class UserInterface():
             - upload them to Google Photos
 
         Arguments:
-            mode ("single"|"collage") : the selected mode
+            mode ("single"|"collage"|"animation") : the selected mode
     """
     def snap(self, mode = "single"):
         import os
@@ -493,19 +633,31 @@ class UserInterface():
         try:
 
             self.camera.resolution = snap_size
-            self.camera.start_preview()
+            self.__start_preview()
 
             timestamp = datetime.datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d_%H-%M-%S")
             self.last_picture_filename  = timestamp + '.jpg'
             self.last_picture_time      = datetime.datetime.now()
             self.last_picture_title     = timestamp
             self.last_picture_mime_type = 'image/jpg'
+            if mode == "animation":
+                self.last_picture_filename  = timestamp + '.gif'
+                self.last_picture_mime_type = 'image/gif'
 
             if mode == "single":
                 filename, picture_taken = self.single_snap()
+            elif mode == "animation":
+                filename, picture_taken = self.animation_snap(snap_size)
             else:
                 filename, picture_taken = self.collage_snap(snap_size, timestamp)
 
+            if filename is None:
+                # countdown cancelled
+                self.log.info("snap: cancelled")
+                self.__stop_preview()
+                self.suspend_poll = False
+                return False
+
             self.log.debug('======================================================')
             self.log.debug('snapshot taken here is the filename:' + filename)
             self.log.debug('======================================================')
@@ -516,7 +668,7 @@ class UserInterface():
             # Here, the photo is in filename
             self.log.info(filename)
             if os.path.exists(filename) & os.path.isfile(filename):
-                if self.send_prints:
+                if self.send_prints and mode != "animation":
                     self.print_btn.place(x=4, y=0)
                 picture_saved, picture_uploaded = self.save_and_upload(filename, timestamp)   
             else:
@@ -527,7 +679,9 @@ class UserInterface():
 
         except Exception, e:
             self.log.exception("snap: error during snapshot")
+            self.set_status("Snap failed :(")
             snapshot = None
+            self.__stop_preview()
 
         self.suspend_poll = False
         
@@ -554,116 +708,180 @@ class UserInterface():
         except:
             pass
 
-    """ Wrapper function to select between overlay and text countdowns """
+    """ Play one of the MP3S clips without waiting for its end """
+    def __play_sound(self, name):
+        self.audio.play(name)
+
+    """ Fire the shutter: capture a frame in memory and play the shutter sound
+
+        returns the captured PIL Image
+    """
+    def __shutter(self):
+        shutter_time = time.time()
+        image = capture_image(self.camera, self.capture_stream)
+        self.__play_sound('shutter')
+        self.__log_shutter_delay(shutter_time)
+        return image
+
+    """ Record the delay between the last countdown beep and the shutter """
+    def __log_shutter_delay(self, shutter_time):
+        beep_time = self.audio.heard_at.get('countdown')
+        if beep_time is not None:
+            self.beep_to_shutter = shutter_time - beep_time
+            self.log.debug("snap: shutter fired %.1fms after the last countdown beep"%(self.beep_to_shutter * 1000))
+
+    """ Fire the shutter for a burst of frames and keep the best one (see Capture.best_frame)
+
+        The other frames are dropped from memory, they are never saved
+        returns the selected PIL Image
+    """
+    def __burst(self, count):
+        shutter_time = time.time()
+        self.__play_sound('shutter')
+        frames, fps = capture_frames(self.camera, count, None, self.capture_stream)
+        self.__log_shutter_delay(shutter_time)
+        start = time.time()
+        best, scores = best_frame(frames)
+        self.log.debug("snap: burst of %d frames at %.1ffps, frame %d selected in %.1fms (scores: %s)"%(
+            count, fps, best + 1, (time.time() - start) * 1000, ", ".join(["%.0f"%score for score in scores])))
+        return frames[best]
+
+    """ Cancel the running countdown (the snap is aborted) """
+    def cancel_countdown(self):
+        if self.countdown is not None:
+            self.countdown.cancel()
+
+    """ Run a countdown while the Tk main loop keeps running
+
+        returns True if the countdown completed, False if it was cancelled
+    """
+    def __run_countdown(self, countdown):
+        self.countdown = countdown
+        try:
+            return countdown.wait()
+        finally:
+            self.countdown = None
+
+    """ Wait for a post-processing result while the Tk main loop keeps running
+
+        returns the result (raises the exception of the job if it failed,
+        IOError if it isn't done after timeout seconds)
+    """
+    def __wait_for(self, result, timeout = POSTPROCESS_TIMEOUT):
+        done = IntVar(self.root, value = 0)
+        deadline = time.time() + timeout
+        def poll():
+            try:
+                if result.ready():
+                    done.set(1)
+                    return
+            except Exception:
+                # get() below raises it again, on this thread
+                done.set(1)
+                return
+            if time.time() > deadline:
+                done.set(2)
+            else:
+                self.root.after(POSTPROCESS_POLL_PERIOD, poll)
+        poll()
+        if done.get() == 0:
+            self.root.wait_variable(done)
+        if done.get() == 2:
+            raise IOError("post-processing not done after %ds"%timeout)
+        return result.get(timeout)
+
+    """ Wrapper function to select between overlay and text countdowns
+
+        returns True when the shutter should fire, False if the countdown was cancelled
+    """
     def __show_countdown(self, countdown, font_size = 160):
-        # self.__show_text_countdown(countdown,font_size=font_size)
-        self.__show_overlay_countdown(countdown)
+        # return self.__show_text_countdown(countdown,font_size=font_size)
+        return self.__show_overlay_countdown(countdown)
 
     """ Display countdown. the camera should have a preview active and the resolution must be set """
     def __show_text_countdown(self, countdown, font_size = 160):
-        led_state = False
-        self.__countdown_set_led(led_state)
+        state = {"led": False}
+        self.__countdown_set_led(False)
 
         self.camera.annotate_text = "" # Remove annotation
         self.camera.annotate_text_size = font_size
-        self.camera.preview.fullscreen = True
-
-        #Change text every second and blink led
-        for i in range(countdown):
-            # Annotation text
-            self.camera.annotate_text = "  " + str(countdown - i) + "  "
-            if i < countdown - 2:
-            # slow blink until -2s
-                time.sleep(1)
-                led_state = not led_state
-                self.__countdown_set_led(led_state)
-            else:
-            # fast blink until the end
-                for j in range(5):
-                    time.sleep(.2)
-                    led_state = not led_state
-                    self.__countdown_set_led(led_state)
+        if self.preview is None:
+            self.camera.preview.fullscreen = True
+
+        #Change text every second and blink led (every 0.2s during the last 2s)
+        def on_tick(remaining):
+            seconds = int(round(remaining * 5)) # remaining, in 0.2s steps
+            if seconds % 5 == 0:
+                # Annotation text
+                self.camera.annotate_text = "  " + str(seconds / 5) + "  "
+            if seconds % 5 == 0 or remaining <= 2:
+                state["led"] = not state["led"]
+                self.__countdown_set_led(state["led"])
+
+        completed = self.__run_countdown(Countdown(self.root, countdown, on_tick = on_tick, period = 0.2))
         self.camera.annotate_text = ""
+        return completed
 
     """ Display countdown as images overlays """
     def __show_overlay_countdown(self, countdown):
         # COUNTDOWN_OVERLAY_IMAGES
-        led_state = False
-        self.__countdown_set_led(led_state)
-
-        self.camera.preview.fullscreen = True
-        self.camera.preview.hflip = True  #Mirror effect for easier selfies
-
-        """ uses the countdown timer to reverse find the correct timer number image
-        this could be simplified if we just reorder the countdown images array
-        """
-        overlay_images = []
-        for i in range(countdown):
-            
-            image_num = countdown -1 -i #3-1-0 ==> 2; 3-1-1 ==> 1; 3-1-2 ==> 0
-            overlay = None
-            image = None
-            
-            if i >= len(COUNTDOWN_OVERLAY_IMAGES):
-                break;
-            if i >= countdown:
-                break;
-
-            image = self.__build_overlay_image(image_num)
-
-            if image == None:
-                continue;
-
+        self.__countdown_set_led(False)
+
+        if self.preview is None:
+            self.camera.preview.fullscreen = True
+            self.camera.preview.hflip = True  #Mirror effect for easier selfies
+
+        state = {"overlay": None}
+        def remove_overlay():
+            if self.preview is not None:
+                self.preview.set_overlay(None)
+            elif state["overlay"] is not None:
+                self.camera.remove_overlay(state["overlay"])
+                state["overlay"] = None
+
+        def on_tick(remaining):
+            """ uses the remaining time to find the correct timer number image
+            (COUNTDOWN_OVERLAY_IMAGES[0] is shown during the last second)
+            """
+            remove_overlay()
+            image_num = min(int(round(remaining)) - 1, len(COUNTDOWN_OVERLAY_IMAGES) - 1)
             try:
-                overlay = self.camera.add_overlay(image.tobytes(), size = image.size)
-                overlay.layer = 3
-                overlay.alpha = 100
-
-                try:
-                    os.system("mpg321 " + MP3S["countdown"])
-                except Exception, e:
-                    self.log.debug(e);
-                    if i <= countdown - 1:
-                        time.sleep(1)
-                    pass
-
+                buffer, size = self.countdown_overlays.get(image_num, self.__preview_size())
+                if self.preview is not None:
+                    self.preview.set_overlay(Image.frombuffer('RGBA', size, buffer, 'raw', 'RGBA', 0, 1))
+                else:
+                    overlay = self.camera.add_overlay(buffer, size = size)
+                    overlay.layer = 3
+                    overlay.alpha = 100
+                    state["overlay"] = overlay
             except Exception, e:
-                self.root.destroy()
-
-            # this timeout is not needed when we used the beeps!
-
-            if overlay != None:
-                self.camera.remove_overlay(overlay)
-
-            led_state = False
-
-    """ Builds the overlay image for the countdown """
-    def __build_overlay_image(self, i):
-
-        screen_width = self.root.winfo_screenwidth()
-        screen_height = self.root.winfo_screenheight()
-
+                self.log.error("countdown: unable to display overlay %d: %s"%(image_num, repr(e)))
+            self.__play_sound("countdown")
+
+        completed = self.__run_countdown(Countdown(self.root, countdown, on_tick = on_tick))
+        remove_overlay()
+        return completed
+
+    """ Size of the camera preview, used to build the countdown overlays """
+    def __preview_size(self):
+        if self.preview is not None:
+            # software preview is rendered in the window
+            return self.size
         # I'm making the bet that preview window size == screen size in fullscreen mode
         # If this fails we should try preview_width = min(screen_width, self.camera.resolution[0])
-        preview_width = screen_width
-        preview_height = screen_height
+        return (self.root.winfo_screenwidth(), self.root.winfo_screenheight())
 
-        overlay_height = int(preview_height * COUNTDOWN_IMAGE_MAX_HEIGHT_RATIO)
-        
-        # read overlay image file
-        file = Image.open(COUNTDOWN_OVERLAY_IMAGES[i])
-        # resize to 20% of height
-        file.thumbnail((preview_width, overlay_height))
+    """ Start the camera preview (software preview in the window for non-picamera backends) """
+    def __start_preview(self):
+        self.camera.start_preview()
+        if self.preview is not None:
+            self.preview.start()
 
-        # overlays should be padded to 32 (width) and 16 (height)
-        pad_width  = int((preview_width + 31) / 32) * 32
-        pad_height = int((preview_height + 15) / 16) * 16
-
-        image = Image.new('RGBA', (pad_width, pad_height))
-        # Paste the original image into the padded one (centered)
-        image.paste(file, ( int((preview_width - file.size[0]) / 2.0), int((preview_height - file.size[1]) / 2.0)))
-
-        return image;
+    """ Stop the camera preview """
+    def __stop_preview(self):
+        self.camera.stop_preview()
+        if self.preview is not None:
+            self.preview.stop()
 
     """ Save or upload the photo - func comment for consistency """
     def save_and_upload(self, filename, timestamp):
@@ -673,100 +891,169 @@ class UserInterface():
         self.log.info('saving and uploading')
         self.log.info(filename)
         self.log.info(timestamp)
-        # 1. Display
+        # 1. Archive (first, so that the display cache and the upload worker get the final location)
+        if self.config.ARCHIVE:
+            picture_saved = self.save_locally(filename)
+            if picture_saved:
+                filename = self.last_picture_filename
+
+        # 2. Display
         self.log.debug("snap: displaying image")
         self.image.load(filename)
 
-        # 2. Upload
-        if self.signed_in:
-            picture_uploaded = self.upload_image_to_google(filename, timestamp)
-        else:
-            self.log.info('not signed in')
-
-        # 3. Archive
-        if config.ARCHIVE:
-            picture_saved = self.save_locally(filename)
+        # 3. Upload (queued, done in the background)
+        picture_uploaded = self.upload_image_to_google(filename, timestamp)
+        self.update_upload_status()
 
         return picture_saved, picture_uploaded
 
-    """ Actual code to email picture self.last_picture_filename
+    """ Queues the email of picture self.last_picture_filename
+
+        The email is sent by the email outbox worker (see __send_email_job),
+        also when the booth was offline at the time of the request
+        Arguments:
+            log_consent (bool|None) : log the address in EMAILS_LOG_FILE (None: don't log)
+        returns True if the email was queued
     """
-    def __send_picture(self):
+    def __send_picture(self, log_consent = None):
         
         if not self.send_emails:
             return False
         
-        retcode = False
-        if self.signed_in:
-            self.set_status("Sending Email")
-            self.log.debug("send_picture: sending picture by email")
-            self.log.debug(self.last_picture_filename)
-            try:
-                retcode = self.oauth2service.send_message(
-                    self.email_addr.get().strip(),
-                    config.emailSubject,
-                    config.emailMsg,
-                    self.last_picture_filename
-                )
-            except Exception, e:
-                self.log.exception('send_picture: Mail sending Failed')
-                self.set_status("Send failed :(")
-                retcode = False
-            else:
-                self.set_status("")
-        else:
-            self.log.error('send_picture: Not signed in')
-            retcode = False
-        return retcode
+        self.log.debug("send_picture: queuing picture %s for email"%self.last_picture_filename)
+        try:
+            self.email_outbox.put({
+                "to": self.email_addr.get().strip(),
+                "subject": self.config.emailSubject,
+                "body": self.config.emailMsg,
+                "filename": os.path.abspath(self.last_picture_filename),
+                "log_consent": log_consent
+            })
+        except Exception, e:
+            self.log.exception('send_picture: unable to queue email')
+            return False
+        self.update_upload_status()
+        return True
 
-    """ Refresh the oauth2 service (regularly called)"""
+    """ Email outbox handler: runs in the worker thread, must not touch Tk widgets
+
+        returns True once sent, raises DropJob if Gmail rejected the message
+        (other errors are retried later)
+    """
+    def __send_email_job(self, job):
+        if not self.send_emails:
+            return None # disabled meanwhile: postponed, not failed
+        if not os.path.isfile(job["filename"]):
+            raise Outbox.DropJob("file %s doesn't exist anymore"%job["filename"])
+        # never start the authorization flow from the worker thread
+        sent = self.oauth2service.send_message(job["to"], job["subject"], job["body"], job["filename"], interactive = False)
+        if sent is None:
+            return None # not signed in: postponed, not failed
+        if job["log_consent"] is not None:
+            self.__log_email_address(job["to"], job["log_consent"], sent, job["filename"])
+        if not sent:
+            raise Outbox.DropJob("message to %s rejected"%job["to"])
+        return True
+
+    """ Start the oauth2 token manager: the token is refreshed in the background """
     def refresh_auth(self):
         # useless if we don't need image upload
         if not (self.upload_images or self.send_emails):
-            if self.send_emails:
-                self.signed_in = True #Will fail otherwise
-                self.mail_btn.configure(state=NORMAL)
             return
-        # actual refresh
-        if self.oauth2service.refresh():
-            # if self.send_emails:
-            #     self.mail_btn.configure(state=NORMAL)
-            self.signed_in = True
-        else:
-            # if self.send_emails:
-            #     self.mail_btn.configure(state=DISABLED)
-            self.signed_in = False
-            self.log.error('refresh_auth: refresh failed')
+        self.oauth2service.start_token_manager()
 
-        #relaunch periodically
-        self.auth_after_id = self.root.after(OAUTH2_REFRESH_PERIOD, self.refresh_auth)
+    """ Update the sign-in state when the token manager signals a change (never blocks) """
+    def check_auth(self):
+        if not self.oauth2service.auth_changed.is_set():
+            return
+        self.oauth2service.auth_changed.clear()
+        self.signed_in = self.oauth2service.signed_in()
+        if not self.signed_in:
+            self.log.error('check_auth: signed out (token refresh failed)')
 
-    """ Uploads the image to google photos """
+    """ Queues the image for upload to google photos
+
+        The upload itself is done by the upload outbox worker (see __upload_jobs)
+        returns True if the image was queued
+    """
     def upload_image_to_google(self, filename, title):
-        picture_uploaded = False
-        self.set_status("Uploading image")
-        self.log.debug("Uploading image")
+        picture_queued = False
+        if not self.upload_images:
+            return picture_queued
+        self.log.debug("Queuing image %s for upload"%filename)
         try:
-            caption = config.photoCaption + " " + title
-            
-            if not self.upload_images:
-                return
+            caption = self.config.photoCaption + " " + title
 
             if caption is None:
-                caption = config.photoCaption
-            if config.albumID == 'None':
-                config.albumID = None
-
-            self.oauth2service.upload_picture(filename, config.albumID, title, caption)
-            self.log.info("Image %s successfully uploaded"%title)
-            self.set_status("")
-
-            picture_uploaded = True
+                caption = self.config.photoCaption
+            if self.config.albumID == 'None':
+                self.config.albumID = None
+
+            self.upload_outbox.put({
+                "filename": os.path.abspath(filename),
+                "album_id": self.config.albumID,
+                "title": title,
+                "caption": caption
+            })
+            picture_queued = True
         except Exception as e:
             self.set_status("Error uploading image :(")
-            self.log.exception("snap: Error uploading image")
+            self.log.exception("snap: Error queuing image for upload")
 
-        return picture_uploaded
+        return picture_queued
+
+    """ Upload outbox preparation: runs in the worker thread as soon as a picture is queued
+
+        Posts the picture binary and keeps the upload token in the job, only the
+        reference of the token waits for other pictures (see __upload_jobs)
+        returns True once uploaded
+    """
+    def __upload_media_job(self, job):
+        if not self.upload_images:
+            return None # disabled meanwhile: postponed, not failed
+        if job.get("upload_token") is not None and time.time() - job.get("uploaded_at", 0) < UPLOAD_TOKEN_LIFETIME:
+            return True # uploaded by a previous attempt, only the reference failed
+        if not os.path.isfile(job["filename"]):
+            raise Outbox.DropJob("file %s doesn't exist anymore"%job["filename"])
+        # never start the authorization flow from the worker thread
+        token = self.oauth2service.upload_media(job["filename"], interactive = False)
+        if token is None:
+            return None # not signed in: postponed, not failed
+        job["upload_token"] = token
+        job["uploaded_at"] = time.time()
+        return True
+
+    """ Upload outbox handler: runs in the worker thread, must not touch Tk widgets
+
+        References the uploaded pictures together (one batchCreate per destination album)
+        returns one result per job
+    """
+    def __upload_jobs(self, jobs):
+        if not self.upload_images:
+            return [None] * len(jobs) # disabled meanwhile: postponed, not failed
+        results = [False] * len(jobs)
+        albums = {}
+        for index, job in enumerate(jobs):
+            albums.setdefault(job["album_id"], []).append(index)
+        for album_id, indexes in albums.items():
+            items = [(jobs[index]["upload_token"], jobs[index]["caption"]) for index in indexes]
+            try:
+                referenced = self.oauth2service.reference_uploads(items, album_id, interactive = False)
+            except Exception as e:
+                self.log.error("Error while referencing %d uploaded image(s) (%s)"%(len(items), str(e)))
+                continue
+            if referenced is None:
+                for index in indexes:
+                    results[index] = None # not signed in: postponed, not failed
+                continue
+            for index, success in zip(indexes, referenced):
+                if success:
+                    self.log.info("Image %s successfully uploaded"%jobs[index]["title"])
+                else:
+                    # the token was rejected: upload the picture again next time
+                    jobs[index]["upload_token"] = None
+                results[index] = success
+        return results
 
     """ Saves the image to a USB drive if available """
     def save_to_usb(self, filename):
@@ -807,20 +1094,20 @@ class UserInterface():
         import os
         self.log.info("Archiving image %s" % filename)
         try:
-            if os.path.exists(config.archive_dir):
+            if os.path.exists(self.config.archive_dir):
                 # new_filename = "%s-photo.jpg" % filename
 
                 # Try to write the picture we've just taken to ALL plugged-in usb keys
-                if config.archive_to_all_usb_drives:
+                if self.config.archive_to_all_usb_drives:
                     self.save_to_usb(filename);
 
                 #Archive on the setup defined directory
-                self.log.info("Archiving to local directory %s" % config.archive_dir)
-                self.last_picture_filename = new_loc = os.path.join(config.archive_dir, filename)
+                self.log.info("Archiving to local directory %s" % self.config.archive_dir)
+                self.last_picture_filename = new_loc = os.path.join(self.config.archive_dir, filename)
                 picture_saved = True
                 os.rename(filename, new_loc)
             else:
-                self.log.error("snap: Error : archive_dir %s doesn't exist" % config.archive_dir)
+                self.log.error("snap: Error : archive_dir %s doesn't exist" % self.config.archive_dir)
         except Exception as e:
             self.set_status("Saving failed :(")
             self.log.exception("Image %s couldn't be saved" % filename)
@@ -861,13 +1148,11 @@ class UserInterface():
                 keyboard_parent = main_frame
                 
                 def onEnter(*args):
-                    filename = self.last_picture_filename
                     self.close_keyboard()
-                    res = self.__send_picture()
-                    if not res:
+                    # the address is logged by the email worker, once the message is sent
+                    if not self.__send_picture(log_consent = (consent_var.get() != 0)):
                         self.set_status("Error sending email")
                         self.log.error("Error sending email")
-                    self.__log_email_address(self.email_addr.get(), consent_var.get()!=0, res, filename)
                 
                 TouchKeyboard(keyboard_parent, self.email_addr, onEnter = onEnter)
                 self.tkkb.wm_attributes("-topmost", 1)
@@ -939,6 +1224,12 @@ class UserInterface():
         self.oauth2service.enable_upload = upload
         self.send_emails = email
         self.upload_images = upload
+        for enabled, outbox in ((email, self.email_outbox), (upload, self.upload_outbox)):
+            if enabled:
+                outbox.resume()
+            else:
+                outbox.pause()
+        self.refresh_auth()
         #TODO show/hide button = OAuthServices.OAuthServices(
         if email:
             self.mail_btn.configure(state=NORMAL)
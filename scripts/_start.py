@@ -1,5 +1,5 @@
 from Tkinter import *
-from UserInterface import UserInterface
+from UserInterface import UserInterface, create_postprocessor
 import Configuration
 import argparse
 import logging
@@ -7,6 +7,9 @@ from constants import *
         
 if __name__ == '__main__':
 
+    # fork the post-processing workers first, while this process has no window nor thread
+    postprocessor = create_postprocessor()
+
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -79,6 +82,6 @@ if __name__ == '__main__':
     logging.getLogger("").addHandler(ch)
 
     """ TODO move every arguments into config file """
-    ui = UserInterface(config, window_size=(SCREEN_W, SCREEN_H), log_level = logging.DEBUG)
+    ui = UserInterface(config, window_size=(SCREEN_W, SCREEN_H), log_level = logging.DEBUG, postprocessor = postprocessor)
 
     ui.start_ui()
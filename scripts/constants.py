@@ -11,10 +11,20 @@ Constants for the TouchSelfie program
     configuration of the hardware buttons' GPIO pins, pull_up_down state and active state
 .. py:data:: EMAIL_BUTTON_IMG  
     'send_email' button icon
-.. py:data:: OAUTH2_REFRESH_PERIOD
-    interval between two OAuth2 token refresh (ms)
 .. py:data:: HARDWARE_POLL_PERIOD = 100
-    polling interval to detect hardware buttons change (ms)
+    polling interval to detect hardware buttons change (ms), when edge detection is not available
+.. py:data:: HOUSEKEEPING_PERIOD = 1000
+    interval of the periodic UI tasks when hardware buttons are event driven (ms)
+.. py:data:: UPLOAD_RETRY_DELAY, UPLOAD_MAX_RETRY_DELAY
+    first and maximum delay between two attempts of a failed upload (s)
+.. py:data:: EMAIL_RETRY_DELAY, EMAIL_MAX_RETRY_DELAY
+    first and maximum delay between two attempts to send an email (s)
+.. py:data:: UPLOAD_BATCH_SIZE, UPLOAD_BATCH_WINDOW
+    maximum number of pictures referenced together, and how long (s) an uploaded picture waits for others
+.. py:data:: UPLOAD_TOKEN_LIFETIME
+    how long (s) the token of an uploaded picture is reused when its reference failed
+.. py:data:: ALBUM_INDEX_TTL
+    how long (s) the album list of the setup assistant is used before being refreshed
 
 .. py:data:: CONFIGURATION_FILE
     name of the configuration file (relative to scripts/ directory)
@@ -22,6 +32,10 @@ Constants for the TouchSelfie program
     name of the 'application_secret' file downloaded from console.developers.google.com (relative to scripts/ directory)
 .. py:data:: CREDENTIALS_STORE_FILE
     name of the automaticaly generated credentials store (relative to scripts/ directory)
+.. py:data:: UPLOAD_OUTBOX_DIR
+    directory holding the pending uploads (relative to scripts/ directory)
+.. py:data:: EMAIL_OUTBOX_DIR
+    directory holding the emails waiting to be sent (relative to scripts/ directory)
 
 """
 import os
@@ -38,17 +52,28 @@ SCREEN_H = 480 ## raspi touch
 # Parameters for the three main effects
 # None: simple shot
 # Four: Collage of four shots
+# Animation: short burst played as a looping GIF
 full_size = (1640,1232)#(2592,1944)
 half_size = (820,616)
+animation_size = (480,360)
 
 MODE_PARAMETERS = {
     "single": {
         'snap_size' : full_size, #(width, height) => preferably use integer division of camera resolution
+        'burst'     : 1,         # 1: single still capture. Opt-in: >1 frames are captured in a row from the
+                                 # video port (lower quality than the still port on a PiCamera), the sharpest one is kept
     },
     "collage": { 
         'snap_size' : half_size,                       #(width, height) of each shots of the 2x2 collage
         'foreground_image' : os.path.join("assets", "collage_four_square.png") # Overlay image on top of the collage
     },
+    "animation": {
+        'snap_size' : animation_size, #(width, height) of each frame
+        'frames'    : 12,             # number of frames captured (all are kept in memory)
+        'fps'       : 6,              # capture rate, also the playback rate
+        'boomerang' : True,           # play forward then backward
+        'colors'    : 128             # GIF palette size
+    },
 }
 
 ICON_DIR = os.path.join("assets", "icons");
@@ -150,7 +175,9 @@ IMAGE_EFFECTS = {
 HARDWARE_BUTTONS = {
     "button_pins": [10,8,12], # Change this and the following to reflect your hardware buttons
     "pull_up_down": "pull_down",        # pull_up or pull_down
-    "active_state": 1         # active 1 GPIO (pull_down with switch to VDD)
+    "active_state": 1,        # active 1 GPIO (pull_down with switch to VDD)
+    "event_driven": True,     # detect presses with GPIO edge callbacks (polling is used if unavailable)
+    "debounce": 200           # presses of a button closer than this are ignored (ms)
 }
 
 #Keyboard shorcuts for actions
@@ -159,10 +186,12 @@ HARDWARE_BUTTONS = {
 ACTIONS_KEYS_MAPPING = {
     "snap_single": ["s", "S", "<F1>"],
     "snap_collage": ["c", "C", "<F2>"],
+    "snap_animation": ["a", "A", "<F3>"],
     "send_email":["e", "@"],
     "send_print":["p", "P"],
     "configure":["q", "Q"],
     "quit":["<Escape>"],
+    "cancel_snap":["x", "X", "<BackSpace>"], # abort the running countdown
     #, "send_print":["p", "P"] #Uncomment if you want to a keyboard shortcut for printing
 }
 
@@ -205,14 +234,48 @@ MP3S = {
     "countdown": os.path.join("assets", "noises", "beep2.mp3")
 }
 
-# Interval in ms between two authentication tokens refreshing
-OAUTH2_REFRESH_PERIOD = 1800000 # interval between two OAuth2 token refresh (ms)
-
 # Polling interval for hardware buttons (ms)
 HARDWARE_POLL_PERIOD = 100
 
+# Interval of the periodic UI tasks when buttons are event driven (ms)
+HOUSEKEEPING_PERIOD = 1000
+
+# The mouse cursor is hidden after this idle time (ms)
+CURSOR_HIDE_DELAY = 3000
+
+# Frame rate of the preview drawn in the window when the camera has no GPU preview (cv2, fake camera)
+SOFTWARE_PREVIEW_FPS = 15
+
+# Polling interval for the end of post-processing jobs (ms)
+POSTPROCESS_POLL_PERIOD = 20
+# A post-processing job not done after this long is considered lost (s)
+POSTPROCESS_TIMEOUT = 30
+
+# Backoff of failed uploads (s): the delay doubles after each failure
+UPLOAD_RETRY_DELAY     = 30
+UPLOAD_MAX_RETRY_DELAY = 1800
+
+# Pictures are emailed as JPEG renditions that fit this size (pixels, None to send the original)
+EMAIL_RENDITION_SIZE    = 1600
+EMAIL_RENDITION_QUALITY = 85
+
+# Backoff of emails that couldn't be sent (s): the delay doubles after each failure
+EMAIL_RETRY_DELAY     = 30
+EMAIL_MAX_RETRY_DELAY = 1800
+
+# Pictures are uploaded at once, the ones uploaded in a row are then referenced
+# in Google Photos with a single request
+UPLOAD_BATCH_SIZE   = 50 # at most 50 items per mediaItems.batchCreate call
+UPLOAD_BATCH_WINDOW = 60 # (s) longer than a shot cycle; flushed on shutdown or once UPLOAD_BATCH_SIZE is reached
+UPLOAD_TOKEN_LIFETIME = 12 * 3600 # (s) Google Photos keeps upload tokens for a day
+
+# The setup assistant keeps the album list for this long (s) before refreshing it
+ALBUM_INDEX_TTL = 600
+
 # Path of various log and configuration files
 CONFIGURATION_FILE     = os.path.join("..", "configuration.json")
 APP_ID_FILE            = os.path.join("..", "google_client_id.json")
 CREDENTIALS_STORE_FILE = os.path.join("..", "google_credentials.dat")
 EMAILS_LOG_FILE        = os.path.join("..", "sendmail.log") # you should activate 'enable_mail_logging' key in configuration.json
+UPLOAD_OUTBOX_DIR      = os.path.join("..", "upload_outbox") # pending uploads, kept across restarts
+EMAIL_OUTBOX_DIR       = os.path.join("..", "email_outbox") # emails waiting to be sent, kept across restarts
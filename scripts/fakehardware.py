@@ -2,6 +2,8 @@
     dummy classes to fake hardware (for test only)
     Laurent Alacoque 2o18
 '''
+import os
+import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -45,8 +47,11 @@ class PiCamera:
         self.previewing = False
         log.info("stoping (fake) preview")
         
-    def capture(self, filename, resize=None):
-        """Generate a new test image"""
+    def capture(self, filename, format=None, resize=None):
+        """Generate a new test image
+
+        filename may also be a writable stream, then format is one of 'jpeg', 'png' or 'rgb'
+        """
         log.info("Generating dummy picture #%d"%self.frame_counter)
         im = Image.new('RGBA', self.resolution, (40,40,40,0))
         self.frame_counter = self.frame_counter + 1
@@ -59,7 +64,12 @@ class PiCamera:
             log.warning("font arial.ttf not found, using default")
             draw.text((10,10), "[%d]"%self.frame_counter, fill=(255,255,255,128))
         im = im.convert('RGB')
-        im.save(filename)
+        if format == 'rgb':
+            filename.write(im.tobytes())
+        elif format is not None:
+            im.save(filename, format = format.upper())
+        else:
+            im.save(filename)
         return True
         
     def add_overlay(self,overlay_image, size=(640,480)):
@@ -70,14 +80,21 @@ class PiCamera:
     def remove_overlay(self,overlay):
         pass
         
-    def capture_continuous(self, output):
-        """Generate a sequence of test images"""
-        #'animframe-{counter:03d}.jpg'
+    def capture_continuous(self, output, format=None, use_video_port=False):
+        """Generate a sequence of test images
+
+        output is a filename pattern ('animframe-{counter:03d}.jpg') or a writable stream
+        (each frame is then written to the stream, as picamera does)
+        """
         counter = 1
         while True:
-            filename = output.format(counter=counter)
-            self.capture(filename)
-            yield filename
+            if isinstance(output, str):
+                filename = output.format(counter=counter)
+                self.capture(filename)
+                yield filename
+            else:
+                self.capture(output, format = format)
+                yield output
             counter += 1
 
             
@@ -85,6 +102,58 @@ class PiCamera:
         """Emulates PiCamera.close()"""
         del self.cam
 
+
+class HardwareButtons:
+    """Fake HardwareButtons: buttons are 'pressed' by calling press()
+
+    Same interface as HardwareButtons.HardwareButtons, in polling or event mode
+    """
+    def __init__(self, buttons_pins=[], mode="pull_down", active_state=1, event_driven=False, debounce=200):
+        self.buttons_pins = buttons_pins
+        self.active_state = active_state
+        self.debounce = debounce / 1000.0
+        self._state = 0
+        self._events = []
+        self._last_press = {}
+        self._pipe = None
+        if event_driven and len(buttons_pins) != 0:
+            self._pipe = os.pipe()
+
+    def has_buttons(self):
+        return len(self.buttons_pins) != 0
+
+    def buttons_number(self):
+        return len(self.buttons_pins)
+
+    def state(self):
+        return self._state
+
+    def events_enabled(self):
+        return self._pipe is not None
+
+    def fileno(self):
+        return self._pipe[0]
+
+    def get_events(self):
+        os.read(self._pipe[0], 512)
+        events = self._events
+        self._events = []
+        return events
+
+    def press(self, button):
+        """Emulates an edge on the pin of button (1 for buttons_pins[0]...), debounced like the real thing"""
+        now = time.time()
+        if now - self._last_press.get(button, 0) < self.debounce:
+            return
+        self._last_press[button] = now
+        self._state = button
+        if self._pipe is not None:
+            self._events.append((button, now))
+            os.write(self._pipe[1], "!")
+
+    def release(self):
+        self._state = 0
+
 if __name__ == '__main__':
     camera = Camera()
     camera.capture("out.jpg")
@@ -13,6 +13,9 @@ import sys
 import configuration
 import constants
 import mykb
+import threading
+import Queue
+from AlbumIndex import AlbumIndex, AlbumSearch
 try:
     import cups
     printer_selection_enable = True
@@ -43,6 +46,8 @@ class Assistant(Tk):
         Tk.__init__(self,*args,**kwargs)
         try:
             self.google_service = None
+            self.album_index = None
+            self.album_index_service = None
             self.printer_selection_enable = printer_selection_enable
             self.config( bg = "white")
             self.config = config
@@ -270,11 +275,7 @@ class Assistant(Tk):
                 top.geometry("450x400")
                 loading_lbl = Label(top,text="Loading album list...", bg='white', font='Helvetica')
                 loading_lbl.pack(fill=X)
-                top.update()
-                album_list = self.google_service.get_user_albums()
-                
-                        
-                loading_lbl.config(text='Use field below to search\nDouble-click on the list to apply')
+
                 #entry and listbox
                 pattern_var = StringVar()
                 pattern_entry = Entry(top,font='Helvetica',textvariable=pattern_var)
@@ -286,36 +287,82 @@ class Assistant(Tk):
                 album_listbox = Listbox(top,height=list_box_items, font='Helvetica', selectmode=SINGLE)
                 album_listbox.pack(fill=X)
 
-                displayed_list_ids=["idstart"]
-                displayed_list_names=["namestart"]
+                # the album list is kept between two openings of this dialog (for the same account)
+                if self.album_index is None or self.album_index_service is not self.google_service:
+                    self.album_index = AlbumIndex(constants.ALBUM_INDEX_TTL)
+                    self.album_index_service = self.google_service
+                index = self.album_index
+                search = AlbumSearch(index)
+                displayed_list_ids=[]
+                displayed_list_names=[]
                 def populate_list(*args):
-                    global displayed_list_ids, displayed_list_names
-                    pattern = pattern_var.get()
-                    #print "applying pattern %s"%pattern
-                    #clear
-                    displayed_list_ids = ["","<New>"]
-                    displayed_list_names=["<No Album>","<Create New>"]
-                    album_listbox.delete(0,END)
-                    album_listbox.insert(END,"<No Album>")
-                    album_listbox.insert(END,"<Create New>")
-                    inserted_items = 0
-                    for i, item in enumerate(album_list):
-                        if inserted_items >= list_box_items-1:
-                            break;
-                        title = item['title']
-                        title_ = title.lower()
-                        id    = item['id']
-                        if title_.find(pattern.lower()) != -1:
-                            album_listbox.insert(END,item['title'])
-                            displayed_list_ids.append(id)
-                            displayed_list_names.append(title)
-                            inserted_items += 1
+                    matches = search.update(pattern_var.get())
+                    ids = ["","<New>"]
+                    names = ["<No Album>","<Create New>"]
+                    for position in matches[:list_box_items-1]:
+                        album = index.album(position)
+                        ids.append(album['id'])
+                        names.append(album['title'])
+                    # only replace the rows that changed
+                    common = 0
+                    while common < min(len(ids),len(displayed_list_ids)) and ids[common] == displayed_list_ids[common] and names[common] == displayed_list_names[common]:
+                        common += 1
+                    album_listbox.delete(common,END)
+                    for name in names[common:]:
+                        album_listbox.insert(END,name)
+                    displayed_list_ids[:] = ids
+                    displayed_list_names[:] = names
+
+                def update_loading_label(loading):
+                    if loading:
+                        loading_lbl.config(text='Loading album list... (%d albums)\nUse field below to search'%len(index))
+                    else:
+                        loading_lbl.config(text='Use field below to search\nDouble-click on the list to apply')
 
+                if index.stale():
+                    # download in the background, results are shown as they arrive
+                    albums = Queue.Queue()
+                    def load_albums():
+                        try:
+                            for album in self.google_service.iter_user_albums():
+                                albums.put(album)
+                            albums.put(None)
+                        except Exception as error:
+                            albums.put(error)
+                    def poll_albums():
+                        if not top.winfo_exists():
+                            return
+                        done = False
+                        received = []
+                        try:
+                            while not done:
+                                album = albums.get_nowait()
+                                if album is None:
+                                    done = True
+                                elif isinstance(album, Exception):
+                                    print "Error while loading the album list: %s"%str(album)
+                                    done = True
+                                else:
+                                    received.append(album)
+                        except Queue.Empty:
+                            pass
+                        index.add(received)
+                        if done and album is None:
+                            index.end_refresh()
+                        populate_list()
+                        update_loading_label(not done)
+                        if not done:
+                            top.after(100,poll_albums)
+                    index.begin_refresh()
+                    loader = threading.Thread(target=load_albums, name="album list")
+                    loader.daemon = True
+                    loader.start()
+                    top.after(100,poll_albums)
+                update_loading_label(index.stale())
 
                 populate_list()
                 pattern_var.trace("w",populate_list)
                 def item_selected(*args):
-                    global displayed_list_ids, displayed_list_names
                     #print "selected!"
                     cursel = album_listbox.curselection()
                     cursel = int(cursel[0])
@@ -329,6 +376,8 @@ class Assistant(Tk):
                             album_id = self.google_service.create_album(album_name = "TouchSelfie", add_placeholder_picture = True)
                             self.album_id_var.set(album_id)   
                             self.album_name_var.set("TouchSelfie")
+                            # the index doesn't know the new album yet
+                            index.loaded_at = None
                         except Exception as e:
                             print(e)
                     else: